@@ -111,6 +111,27 @@ def analyze(data: dict) -> dict:
     return res
 
 
+def tile_boxes(data: dict) -> list:
+    """Render tiles as (x, y, box in dbu, size in px), the order and naming of the RAW files"""
+    info = analyze(data)
+    res = []
+
+    # tile size in dbu and px
+    gds_t_w = info['tot_gds_width'] / info['tiles_w']
+    gds_t_h = info['tot_gds_height'] / info['tiles_h']
+    t_size_w = int(data['image']['overrender_factor'] * info['image_w'] / info['tiles_w'])
+    t_size_h = int(data['image']['overrender_factor'] * info['image_h'] / info['tiles_h'])
+
+    for x in range(info['tiles_w']):
+        for y in range(info['tiles_h']):
+            left = info['tot_gds_x_offset'] + x * gds_t_w
+            bottom = info['tot_gds_y_offset'] + y * gds_t_h
+            res.append((x, y, [left, bottom, left + gds_t_w, bottom + gds_t_h],
+                        (t_size_w, t_size_h)))
+
+    return res
+
+
 def emit_color_preview(data: dict, colors: dict) -> str:
     svg_body = ''
     y = 4
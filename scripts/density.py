@@ -0,0 +1,133 @@
+# Copyright 2025 ETH Zurich and University of Bologna.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Thomas Benz <tbenz@iis.ee.ethz.ch>
+# Paul Scheffler <paulsc@iis.ee.ethz.ch>
+# Nils Wistoff <nwistoff@iis.ee.ethz.ch>
+# Philippe Sauter <phsauter@iis.ee.ethz.ch>
+
+"""Compute per-layer metal density maps from the polygon store"""
+
+import argparse
+import json
+import math
+import numpy as np
+
+from PIL import Image
+
+import poly_store
+from raster import coverage as coverage
+
+# heatmap color anchors from 0 % to 100 % density
+HEATMAP = [(0.00, (0, 0, 0)),
+           (0.25, (32, 32, 160)),
+           (0.50, (0, 160, 96)),
+           (0.75, (240, 200, 0)),
+           (1.00, (255, 32, 0))]
+
+
+def density_grid(store: dict, arrays: dict, step: int) -> tuple:
+    """Density of each step x step dbu cell covering the store, first row on top
+
+    The store is processed bin row by bin row to bound the memory, reading each row by its
+    index; polygons are clipped to their bins, so the coverage of the bin rows adds up exactly.
+    """
+    grid = store['grid']
+    x0 = math.floor(grid['x0'] / step) * step
+    y0 = math.floor(grid['y0'] / step) * step
+    cols = math.ceil((grid['x0'] + grid['nx'] * grid['bin_w'] - x0) / step)
+    rows = math.ceil((grid['y0'] + grid['ny'] * grid['bin_h'] - y0) / step)
+    top = y0 + rows * step
+    res = np.zeros((rows, cols), dtype=np.float64)
+
+    for iy in range(grid['ny']):
+        bottom = grid['y0'] + iy * grid['bin_h']
+        r0 = max(math.floor((top - (bottom + grid['bin_h'])) / step), 0)
+        r1 = min(math.ceil((top - bottom) / step), rows)
+        box = [x0, top - r1 * step, x0 + cols * step, top - r0 * step]
+        row = poly_store.query_bins(store, arrays, 0, grid['nx'], iy, iy + 1)
+        res[r0:r1] += coverage(row, box, (cols, r1 - r0))
+
+    return np.clip(res, 0.0, 1.0), [x0, y0, x0 + cols * step, top]
+
+
+def window_density(cells: np.ndarray, size: int) -> np.ndarray:
+    """Mean density of all size x size cell windows, stepped by one cell, via a summed-area table"""
+    sat = np.zeros((cells.shape[0] + 1, cells.shape[1] + 1), dtype=np.float64)
+    sat[1:, 1:] = np.cumsum(np.cumsum(cells, axis=0), axis=1)
+    sums = sat[size:, size:] - sat[:-size, size:] - sat[size:, :-size] + sat[:-size, :-size]
+    return np.maximum(sums, 0.0) / size**2
+
+
+def heatmap(values: np.ndarray, scale: int = 1) -> Image.Image:
+    """Color a density map in [0, 1]"""
+    pos = [a[0] for a in HEATMAP]
+    lut = np.stack([np.interp(np.linspace(0, 1, 256), pos, [a[1][c] for a in HEATMAP])
+                    for c in range(3)], axis=-1).astype(np.uint8)
+    img = Image.fromarray(lut[np.rint(np.clip(values, 0, 1) * 255).astype(np.uint8)], 'RGB')
+    if scale != 1:
+        img = img.resize((img.width * scale, img.height * scale), Image.NEAREST)
+    return img
+
+
+def analyze_density(data: dict, step_um: float, window_um: float, layers: list,
+                    min_density: float, max_density: float, scale: int):
+    """Write density arrays and heatmaps of each layer and print a summary"""
+    store = poly_store.open_store(poly_store.store_dir(data))
+    dbu_um = store['dbu']
+    step = round(step_um / dbu_um)
+    size = max(round(window_um / step_um), 1)
+    prefix = f'{data["work"]["dir"]}/DENS__{data["general"]["chip"]}'
+
+    print(f'{"Layer":8} {"min %":>8} {"mean %":>8} {"max %":>8} {"violations":>12}')
+    for layer in layers or data['colors']:
+        arrays = poly_store.load_layer(store, layer)
+        cells, box = density_grid(store, arrays, step)
+        windows = window_density(cells, size) if size <= min(cells.shape) else cells
+
+        # write arrays and heatmaps
+        np.save(f'{prefix}_{layer}.npy', cells.astype(np.float32))
+        np.save(f'{prefix}_{layer}_w{window_um:g}.npy', windows.astype(np.float32))
+        heatmap(cells, scale).save(f'{prefix}_{layer}.png')
+        heatmap(windows, scale).save(f'{prefix}_{layer}_w{window_um:g}.png')
+
+        violations = np.count_nonzero((windows * 100 < min_density) |
+                                      (windows * 100 > max_density))
+        print(f'{layer:8} {windows.min() * 100:8.2f} {windows.mean() * 100:8.2f} '
+              f'{windows.max() * 100:8.2f} {violations:12}')
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser(
+                        prog='density',
+                        description='Compute per-layer metal density maps')
+
+    parser.add_argument('chip_json', help='The chip configuration', type=str)
+
+    parser.add_argument('-s', '--step', default=10.0, required=False,
+                        help='Grid step in um', type=float)
+
+    parser.add_argument('-w', '--window', default=50.0, required=False,
+                        help='Sliding window size in um, a multiple of the step', type=float)
+
+    parser.add_argument('-l', '--layers', nargs='*', default=None,
+                        help='Only analyze these layers', type=str)
+
+    parser.add_argument('--min', default=0.0, required=False,
+                        help='Minimum window density in percent', type=float)
+
+    parser.add_argument('--max', default=100.0, required=False,
+                        help='Maximum window density in percent', type=float)
+
+    parser.add_argument('--scale', default=1, required=False,
+                        help='Heatmap pixels per grid cell', type=int)
+
+    # get the args and process them
+    args = parser.parse_args()
+
+    with open(args.chip_json, 'r') as f:
+        data = json.load(f)
+
+    analyze_density(data, args.step, args.window, args.layers, args.min, args.max, args.scale)
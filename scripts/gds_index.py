@@ -0,0 +1,383 @@
+# Copyright 2025 ETH Zurich and University of Bologna.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Thomas Benz <tbenz@iis.ee.ethz.ch>
+# Paul Scheffler <paulsc@iis.ee.ethz.ch>
+# Nils Wistoff <nwistoff@iis.ee.ethz.ch>
+# Philippe Sauter <phsauter@iis.ee.ethz.ch>
+
+"""Index a GDSII stream for random access and extract the cells of a window"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import numpy as np
+
+import gdsii
+
+INDEX_VERSION = 1
+
+# warn if a gzip member is larger than this, random access becomes expensive
+MAX_MEMBER_SIZE = 1 << 22
+
+# columns of a placement: origin, rotation, magnification, reflection, and the
+# array size and pitch vectors (1, 1, 0, 0, 0, 0 for single references)
+PLACEMENT_FIELDS = ['x', 'y', 'angle', 'mag', 'reflect', 'cols', 'rows',
+                    'col_x', 'col_y', 'row_x', 'row_y']
+
+
+def _merge_bbox(bbox: list, xs, ys, grow: int = 0) -> list:
+    lo_x, hi_x, lo_y, hi_y = min(xs) - grow, max(xs) + grow, min(ys) - grow, max(ys) + grow
+    if bbox is None:
+        return [lo_x, lo_y, hi_x, hi_y]
+    return [min(bbox[0], lo_x), min(bbox[1], lo_y), max(bbox[2], hi_x), max(bbox[3], hi_y)]
+
+
+def _placement(element: list) -> tuple:
+    """Decode the referenced structure and placement of an SREF/AREF"""
+    sname = None
+    angle = 0.0
+    mag = 1.0
+    reflect = 0
+    cols = rows = 1
+    xy = None
+    for _, rtype, _, payload in element:
+        if rtype == gdsii.SNAME:
+            sname = gdsii.parse_string(payload)
+        elif rtype == gdsii.STRANS:
+            reflect = int(bool(gdsii.parse_int2(payload)[0] & gdsii.STRANS_REFLECT))
+        elif rtype == gdsii.MAG:
+            mag = gdsii.parse_real8(payload)[0]
+        elif rtype == gdsii.ANGLE:
+            angle = gdsii.parse_real8(payload)[0]
+        elif rtype == gdsii.COLROW:
+            cols, rows = gdsii.parse_int2(payload)
+        elif rtype == gdsii.XY:
+            xy = gdsii.parse_int4(payload)
+
+    if element[0][1] == gdsii.AREF:
+        col = [(xy[2] - xy[0]) / cols, (xy[3] - xy[1]) / cols]
+        row = [(xy[4] - xy[0]) / rows, (xy[5] - xy[1]) / rows]
+    else:
+        col = row = [0, 0]
+    return sname, [xy[0], xy[1], angle, mag, reflect, cols, rows, *col, *row]
+
+
+def scan_gds(stream) -> dict:
+    """Scan a decompressed GDSII stream and collect the per-structure information"""
+    index = {'version': INDEX_VERSION, 'units': None, 'header': None, 'structures': {}}
+    structs = index['structures']
+    current = None
+    name = None
+
+    for rtype, element in gdsii.iter_elements(gdsii.iter_records(stream)):
+        offset = element[0][0]
+
+        if rtype == gdsii.UNITS:
+            index['units'] = gdsii.parse_real8(element[0][3])
+
+        elif rtype == gdsii.BGNSTR:
+            if index['header'] is None:
+                index['header'] = offset
+            current = {'offset': offset, 'length': 0, 'local_bbox': None, 'layers': set(),
+                       'refs': {}}
+
+        elif rtype == gdsii.STRNAME:
+            name = gdsii.parse_string(element[0][3])
+
+        elif rtype == gdsii.ENDSTR:
+            current['length'] = offset + 4 - current['offset']
+            current['layers'] = sorted(current['layers'])
+            structs[name] = current
+            current = None
+
+        elif rtype == gdsii.ENDLIB:
+            if index['header'] is None:
+                index['header'] = offset
+            index['size'] = offset + 4
+
+        elif rtype in (gdsii.SREF, gdsii.AREF):
+            sname, place = _placement(element)
+            current['refs'].setdefault(sname, []).append(place)
+
+        elif rtype in gdsii.ELEMENTS:
+            current['layers'].add(gdsii.element_info(element))
+            grow = 0
+            for _, r, _, payload in element:
+                if r == gdsii.WIDTH:
+                    grow = abs(gdsii.parse_int4(payload)[0]) // 2
+            for _, r, _, payload in element:
+                if r == gdsii.XY and rtype != gdsii.TEXT:
+                    xy = gdsii.parse_int4(payload)
+                    current['local_bbox'] = _merge_bbox(current['local_bbox'], xy[0::2], xy[1::2],
+                                                        grow)
+
+    _resolve_bboxes(structs)
+    return index
+
+
+def _ref_matrices(places: np.ndarray) -> np.ndarray:
+    """2x2 linear part of the placements' transformations"""
+    rad = np.radians(places[:, 2])
+    mag = places[:, 3]
+    flip = np.where(places[:, 4] > 0, -1.0, 1.0)
+    cos, sin = np.cos(rad) * mag, np.sin(rad) * mag
+    return np.stack([np.stack([cos, -sin * flip], axis=-1),
+                     np.stack([sin, cos * flip], axis=-1)], axis=-2)
+
+
+def _instances(places: np.ndarray) -> tuple:
+    """Expand array references to (placement row, origin) of all instances"""
+    counts = (places[:, 5] * places[:, 6]).astype(np.int64)
+    rows = np.repeat(np.arange(len(places)), counts)
+    if len(rows) == len(places):
+        return rows, places[:, 0:2]
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    k = np.arange(len(rows)) - first
+    i, j = k % places[rows, 5], k // places[rows, 5]
+    origin = places[rows, 0:2] + i[:, None] * places[rows, 7:9] + j[:, None] * places[rows, 9:11]
+    return rows, origin
+
+
+def _placed_bboxes(bbox: list, matrices: np.ndarray, origins: np.ndarray) -> np.ndarray:
+    """Bounding boxes (N, 4) of a child bbox under the given transformations"""
+    corners = np.array([[bbox[0], bbox[2], bbox[2], bbox[0]],
+                        [bbox[1], bbox[1], bbox[3], bbox[3]]], dtype=float)
+    moved = matrices @ corners
+    return np.concatenate([moved.min(axis=2) + origins, moved.max(axis=2) + origins], axis=1)
+
+
+def _resolve_bboxes(structs: dict):
+    """Compute the hierarchical bounding box of each structure, children first"""
+    done = {}
+    for root in structs:
+        stack = [root]
+        while stack:
+            name = stack[-1]
+            if name in done:
+                stack.pop()
+                continue
+            pending = [c for c in structs[name]['refs'] if c in structs and c not in done]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+
+            bbox = structs[name]['local_bbox']
+            for child, places in structs[name]['refs'].items():
+                if done.get(child) is None:
+                    continue
+                places = np.array(places, dtype=float)
+                rows, origins = _instances(places)
+                boxes = _placed_bboxes(done[child], _ref_matrices(places)[rows], origins)
+                bbox = _merge_bbox(bbox, [np.floor(boxes[:, 0].min()), np.ceil(boxes[:, 2].max())],
+                                   [np.floor(boxes[:, 1].min()), np.ceil(boxes[:, 3].max())])
+            done[name] = None if bbox is None else [int(v) for v in bbox]
+            structs[name]['bbox'] = done[name]
+
+
+def index_gds(gds_file: str, out_gds: str = None) -> dict:
+    """Index a GDS stream; gzipped streams are optionally repacked block-compressed"""
+    index = None
+    with open(gds_file, 'rb') as raw:
+        if not gds_file.endswith('.gz'):
+            index = scan_gds(raw)
+            index['file'] = os.path.abspath(gds_file)
+            index['blocks'] = None
+
+        elif out_gds is not None:
+            writer = gdsii.BlockGzipWriter(out_gds)
+            index = scan_gds(gdsii.TeeReader(gdsii.GzipMemberReader(raw), writer))
+            index['file'] = os.path.abspath(out_gds)
+            index['blocks'] = writer.close()
+
+        else:
+            reader = gdsii.GzipMemberReader(raw)
+            index = scan_gds(reader)
+            index['file'] = os.path.abspath(gds_file)
+            index['blocks'] = reader.block_table()
+            member = max(b[0] - a[0] for a, b in zip(index['blocks'], index['blocks'][1:]))
+            if member > MAX_MEMBER_SIZE:
+                print(f'{gds_file} is not block-compressed (member of {member} bytes), '
+                      'repack it using --out_gds for fast random access', file=sys.stderr)
+
+    return index
+
+
+def write_index(index: dict, index_file: str):
+    with gzip.open(index_file, 'wt') as f:
+        json.dump(index, f)
+
+
+def read_index(index_file: str) -> dict:
+    with gzip.open(index_file, 'rt') as f:
+        index = json.load(f)
+    if index.get('version') != INDEX_VERSION:
+        raise ValueError(f'Unsupported index version in {index_file}')
+    return index
+
+
+def top_cells(index: dict) -> list:
+    structs = index['structures']
+    children = {c for s in structs.values() for c in s['refs']}
+    return [name for name in structs if name not in children]
+
+
+def _descendants(structs: dict) -> dict:
+    res = {}
+    for root in structs:
+        stack = [root]
+        while stack:
+            name = stack[-1]
+            pending = [c for c in structs[name]['refs'] if c in structs and c not in res]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            res[name] = set()
+            for c in structs[name]['refs']:
+                if c in structs:
+                    res[name] |= {c} | res[c]
+    return res
+
+
+def cells_in_window(index: dict, box: list, tops: list = None) -> set:
+    """Names of all structures with instances intersecting the box (dbu: x0, y0, x1, y1)"""
+    structs = index['structures']
+    descendants = _descendants(structs)
+    found = set()
+
+    def overlaps(boxes):
+        return (boxes[:, 0] < box[2]) & (boxes[:, 2] > box[0]) & \
+               (boxes[:, 1] < box[3]) & (boxes[:, 3] > box[1])
+
+    stack = []
+    for top in tops or top_cells(index):
+        bbox = structs[top]['bbox']
+        if bbox is not None and overlaps(np.array([bbox]))[0]:
+            found.add(top)
+            stack.append((top, np.eye(2), np.zeros(2)))
+
+    # descend into the placements intersecting the window
+    while stack:
+        name, mat, org = stack.pop()
+        for child, places in structs[name]['refs'].items():
+            if child not in structs or structs[child]['bbox'] is None:
+                continue
+            if child in found and descendants[child] <= found:
+                continue
+            places = np.array(places, dtype=float)
+            rows, origins = _instances(places)
+            matrices = mat @ _ref_matrices(places)[rows]
+            origins = origins @ mat.T + org
+            hits = np.flatnonzero(overlaps(_placed_bboxes(structs[child]['bbox'], matrices,
+                                                          origins)))
+            if len(hits):
+                found.add(child)
+            for hit in hits:
+                if descendants[child] <= found:
+                    break
+                stack.append((child, matrices[hit], origins[hit]))
+
+    return found
+
+
+def extract(index: dict, names: set, out_file: str, layers: set = None):
+    """Write the header and the given structures, optionally only some layers, to a new GDS"""
+    reader = gdsii.RandomAccessReader(index['file'], index['blocks'])
+    structs = index['structures']
+
+    with gdsii.open_gds(out_file, 'wb') as out:
+        out.write(reader.read_at(0, index['header']))
+        for name in sorted(names, key=lambda n: structs[n]['offset']):
+            data = reader.read_at(structs[name]['offset'], structs[name]['length'])
+            records = gdsii.iter_records(_BytesStream(data))
+            for rtype, element in gdsii.iter_elements(records):
+                info = gdsii.element_info(element) if rtype in gdsii.ELEMENTS else None
+                if rtype in (gdsii.SREF, gdsii.AREF) and info not in names:
+                    continue
+                if layers is not None and isinstance(info, tuple) and info not in layers:
+                    continue
+                for _, r, d, payload in element:
+                    out.write(gdsii.pack_record(r, d, payload))
+        out.write(gdsii.pack_record(gdsii.ENDLIB, gdsii.NO_DATA))
+
+    reader.close()
+
+
+def extract_window(index: dict, box: list, out_file: str, layers: set = None) -> set:
+    """Write the cells intersecting a window (dbu) to a new GDS, returns the cells written"""
+    names = cells_in_window(index, box)
+    extract(index, names, out_file, layers)
+    return names
+
+
+class _BytesStream:
+    """Minimal stream over an in-memory buffer"""
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def read(self, size: int) -> bytes:
+        res = self.data[self.pos:self.pos + size]
+        self.pos += len(res)
+        return res
+
+
+def um_to_dbu(index: dict, values: list) -> list:
+    """Convert micrometers to database units of the indexed library"""
+    return [round(v * 1e-6 / index['units'][1]) for v in values]
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser(
+                        prog='gds_index',
+                        description='Index a GDSII stream for random access')
+
+    parser.add_argument('-i', '--in_gds', required=False,
+                        help='The GDS to index, plain or gzipped', type=str)
+
+    parser.add_argument('-o', '--out_gds', required=False,
+                        help='Repack a gzipped input block-compressed to this file', type=str)
+
+    parser.add_argument('-x', '--index', required=False,
+                        help='The index file, defaults to <gds>.idx', type=str)
+
+    parser.add_argument('-b', '--box', required=False,
+                        help='Query window in um: left,bottom,right,top', type=str)
+
+    parser.add_argument('-l', '--layers', required=False,
+                        help='Extract only these layers: layer/datatype,...', type=str)
+
+    parser.add_argument('-e', '--extract', required=False,
+                        help='Write the cells intersecting the window to this GDS', type=str)
+
+    # get the args and process them
+    args = parser.parse_args()
+
+    if args.in_gds:
+        index = index_gds(args.in_gds, args.out_gds)
+        index_file = args.index or f'{args.out_gds or args.in_gds}.idx'
+        write_index(index, index_file)
+        print(f'Indexed {len(index["structures"])} structures to {index_file}')
+    elif args.index:
+        index = read_index(args.index)
+    else:
+        print('Either specify --in_gds or --index')
+        sys.exit(-1)
+
+    if args.box:
+        box = um_to_dbu(index, [float(v) for v in args.box.split(',')])
+        cells = cells_in_window(index, box)
+        print(f'{len(cells)} of {len(index["structures"])} structures intersect the window')
+
+        if args.extract:
+            layers = None
+            if args.layers:
+                layers = {tuple(int(v) for v in ld.split('/')) for ld in args.layers.split(',')}
+            extract(index, cells, args.extract, layers)
@@ -0,0 +1,187 @@
+# Copyright 2025 ETH Zurich and University of Bologna.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Thomas Benz <tbenz@iis.ee.ethz.ch>
+# Paul Scheffler <paulsc@iis.ee.ethz.ch>
+# Nils Wistoff <nwistoff@iis.ee.ethz.ch>
+# Philippe Sauter <phsauter@iis.ee.ethz.ch>
+
+"""Export the top-metal layer and merge a logo by streaming GDSII records, without KLayout"""
+
+import argparse
+import ast
+import time
+
+import gdsii
+
+
+def scan_hierarchy(gds_file: str, layer: tuple) -> tuple:
+    """Names of the structures holding elements on `layer`, and the references of each"""
+    holding = set()
+    refs = {}
+    name = None
+    with gdsii.open_gds(gds_file) as stream:
+        for rtype, element in gdsii.iter_elements(gdsii.iter_records(stream)):
+            if rtype == gdsii.STRNAME:
+                name = gdsii.parse_string(element[0][3])
+                refs[name] = set()
+            elif rtype in (gdsii.SREF, gdsii.AREF):
+                refs[name].add(gdsii.element_info(element))
+            elif rtype in gdsii.ELEMENTS and gdsii.element_info(element) == layer:
+                holding.add(name)
+    return holding, refs
+
+
+def kept_structures(holding: set, refs: dict) -> set:
+    """Structures holding elements themselves or through their references"""
+    parents = {}
+    for name, children in refs.items():
+        for child in children:
+            parents.setdefault(child, set()).add(name)
+
+    kept = set()
+    stack = list(holding)
+    while stack:
+        name = stack.pop()
+        if name not in kept:
+            kept.add(name)
+            stack.extend(parents.get(name, ()))
+    return kept
+
+
+def extract_layer(in_gds: str, out_gds: str, layer: tuple) -> int:
+    """Copy the elements on `layer` (layer, datatype) with their hierarchy, returns the cells
+
+    The stream is read twice: once to find the structures holding the layer, and once to copy
+    them, dropping the elements on other layers and the references to empty structures.
+    """
+    kept = kept_structures(*scan_hierarchy(in_gds, layer))
+
+    with gdsii.open_gds(in_gds) as stream, gdsii.open_gds(out_gds, 'wb') as out:
+        bgnstr = None
+        skip = False
+        for rtype, element in gdsii.iter_elements(gdsii.iter_records(stream)):
+            # the structure name follows BGNSTR
+            if rtype == gdsii.BGNSTR:
+                bgnstr = element
+                continue
+            if rtype == gdsii.STRNAME:
+                skip = gdsii.parse_string(element[0][3]) not in kept
+                if skip:
+                    continue
+                element = bgnstr + element
+
+            if skip:
+                skip = rtype != gdsii.ENDSTR
+                continue
+            if rtype in (gdsii.SREF, gdsii.AREF):
+                if gdsii.element_info(element) not in kept:
+                    continue
+            elif rtype in gdsii.ELEMENTS and gdsii.element_info(element) != layer:
+                continue
+
+            for _, r, d, payload in element:
+                out.write(gdsii.pack_record(r, d, payload))
+
+    return len(kept)
+
+
+def _scale_int4(payload: bytes, scale: float) -> bytes:
+    return gdsii.pack_int4([round(v * scale) for v in gdsii.parse_int4(payload)])
+
+
+def merge_libraries(in_gds: str, logo_gds: str, out_gds: str, new_top: str) -> list:
+    """Append the structures of the logo and a new top referencing all tops, returns the tops
+
+    The chip is copied record by record; the coordinates of the logo are scaled if its
+    database unit differs from the one of the chip.
+    """
+    names = []
+    children = set()
+    units = None
+
+    with gdsii.open_gds(out_gds, 'wb') as out:
+        with gdsii.open_gds(in_gds) as stream:
+            for _, rtype, dtype, payload in gdsii.iter_records(stream):
+                if rtype == gdsii.ENDLIB:
+                    break
+                if rtype == gdsii.UNITS:
+                    units = gdsii.parse_real8(payload)
+                elif rtype == gdsii.STRNAME:
+                    names.append(gdsii.parse_string(payload))
+                elif rtype == gdsii.SNAME:
+                    children.add(gdsii.parse_string(payload))
+                out.write(gdsii.pack_record(rtype, dtype, payload))
+
+        # the library records of the logo precede its first structure and are dropped
+        chip_names = set(names)
+        in_header = True
+        scale = 1.0
+        with gdsii.open_gds(logo_gds) as stream:
+            for _, rtype, dtype, payload in gdsii.iter_records(stream):
+                if rtype == gdsii.ENDLIB:
+                    break
+                if rtype == gdsii.UNITS:
+                    scale = gdsii.parse_real8(payload)[1] / units[1]
+                elif rtype == gdsii.BGNSTR:
+                    in_header = False
+                if in_header:
+                    continue
+
+                if rtype == gdsii.STRNAME:
+                    name = gdsii.parse_string(payload)
+                    if name in chip_names:
+                        raise ValueError(f'Structure {name} of {logo_gds} exists in {in_gds}')
+                    names.append(name)
+                elif rtype == gdsii.SNAME:
+                    children.add(gdsii.parse_string(payload))
+                elif rtype in (gdsii.XY, gdsii.WIDTH) and abs(scale - 1.0) > 1e-9:
+                    payload = _scale_int4(payload, scale)
+                out.write(gdsii.pack_record(rtype, dtype, payload))
+
+        if new_top in names:
+            raise ValueError(f'Structure {new_top} exists already')
+        tops = [name for name in names if name not in children]
+
+        # new top structure, stamped with the current time for modification and access
+        stamp = list(time.localtime()[:6]) * 2
+        out.write(gdsii.pack_record(gdsii.BGNSTR, gdsii.INT2, gdsii.pack_int2(stamp)))
+        out.write(gdsii.pack_record(gdsii.STRNAME, gdsii.ASCII, new_top.encode('ascii')))
+        for top in tops:
+            out.write(gdsii.pack_record(gdsii.SREF, gdsii.NO_DATA))
+            out.write(gdsii.pack_record(gdsii.SNAME, gdsii.ASCII, top.encode('ascii')))
+            out.write(gdsii.pack_record(gdsii.XY, gdsii.INT4, gdsii.pack_int4([0, 0])))
+            out.write(gdsii.pack_record(gdsii.ENDEL, gdsii.NO_DATA))
+        out.write(gdsii.pack_record(gdsii.ENDSTR, gdsii.NO_DATA))
+        out.write(gdsii.pack_record(gdsii.ENDLIB, gdsii.NO_DATA))
+
+    return tops
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser(
+                        prog='gds_stream',
+                        description='Export the top metal or merge the logo without KLayout')
+
+    parser.add_argument('mode', choices=['export', 'merge'],
+                        help='Export the top-metal layer or merge the logo into the chip')
+
+    parser.add_argument('-d', '--design', default='meerkat_design.py', required=False,
+                        help='The interface file written by meerkat_interface.py', type=str)
+
+    # get the args and process them
+    args = parser.parse_args()
+
+    with open(args.design) as design:
+        cfg = ast.literal_eval(design.read())
+
+    if args.mode == 'export':
+        num = extract_layer(cfg['in_gds'], cfg['metal_gds'],
+                            (int(cfg['layer']), int(cfg['datatype'])))
+        print(f'Exported layer {cfg["layer"]}/{cfg["datatype"]} of {num} cells to '
+              f'{cfg["metal_gds"]}')
+    else:
+        top_list = merge_libraries(cfg['in_gds'], cfg['logo_gds'], cfg['out_gds'], cfg['new_top'])
+        print(f'Merged {", ".join(top_list)} under {cfg["new_top"]} to {cfg["out_gds"]}')
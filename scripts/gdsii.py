@@ -0,0 +1,311 @@
+# Copyright 2025 ETH Zurich and University of Bologna.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Thomas Benz <tbenz@iis.ee.ethz.ch>
+# Paul Scheffler <paulsc@iis.ee.ethz.ch>
+# Nils Wistoff <nwistoff@iis.ee.ethz.ch>
+# Philippe Sauter <phsauter@iis.ee.ethz.ch>
+
+"""Low-level GDSII stream records and block-compressed gzip helpers"""
+
+import bisect
+import gzip
+import struct
+import zlib
+from array import array
+
+# record types
+HEADER = 0x00
+BGNLIB = 0x01
+LIBNAME = 0x02
+UNITS = 0x03
+ENDLIB = 0x04
+BGNSTR = 0x05
+STRNAME = 0x06
+ENDSTR = 0x07
+BOUNDARY = 0x08
+PATH = 0x09
+SREF = 0x0a
+AREF = 0x0b
+TEXT = 0x0c
+LAYER = 0x0d
+DATATYPE = 0x0e
+WIDTH = 0x0f
+XY = 0x10
+ENDEL = 0x11
+SNAME = 0x12
+COLROW = 0x13
+NODE = 0x15
+TEXTTYPE = 0x16
+STRANS = 0x1a
+MAG = 0x1b
+ANGLE = 0x1c
+PATHTYPE = 0x21
+NODETYPE = 0x2a
+BOX = 0x2d
+BOXTYPE = 0x2e
+
+# data types
+NO_DATA = 0x00
+INT2 = 0x02
+INT4 = 0x03
+REAL8 = 0x05
+ASCII = 0x06
+
+# elements and the record holding their "datatype"
+ELEMENTS = {BOUNDARY: DATATYPE, PATH: DATATYPE, SREF: None, AREF: None, TEXT: TEXTTYPE,
+            NODE: NODETYPE, BOX: BOXTYPE}
+
+# reflection bit of STRANS
+STRANS_REFLECT = 0x8000
+
+# stream read granularity
+CHUNK_SIZE = 1 << 22
+
+# uncompressed size of one gzip block, matches BGZF
+BLOCK_SIZE = 0xff00
+
+
+def open_gds(path: str, mode: str = 'rb'):
+    """Open a plain or gzipped GDS stream"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode, buffering=CHUNK_SIZE)
+
+
+def iter_records(stream, chunk_size: int = CHUNK_SIZE):
+    """Yield (offset, record type, data type, payload) for each record of a stream"""
+    buf = b''
+    pos = 0
+    base = 0
+    while True:
+        # refill the buffer if the record header is not complete
+        if len(buf) - pos < 4:
+            buf, base, pos = buf[pos:] + stream.read(chunk_size), base + pos, 0
+            if len(buf) < 4:
+                return
+
+        length = (buf[pos] << 8) | buf[pos + 1]
+        if length < 4:
+            raise ValueError(f'Invalid record of length {length} at offset {base + pos}')
+
+        # refill the buffer if the record payload is not complete
+        if len(buf) - pos < length:
+            more = stream.read(max(chunk_size, length))
+            if not more:
+                raise ValueError(f'Truncated record at offset {base + pos}')
+            buf, base, pos = buf[pos:] + more, base + pos, 0
+            continue
+
+        rtype = buf[pos + 2]
+        yield base + pos, rtype, buf[pos + 3], buf[pos + 4:pos + length]
+        pos += length
+
+        # the stream may be padded after the end of the library
+        if rtype == ENDLIB:
+            return
+
+
+def iter_elements(records):
+    """Group records to (record type, records) items; elements are closed by ENDEL"""
+    element = None
+    for rec in records:
+        rtype = rec[1]
+        if element is not None:
+            element.append(rec)
+            if rtype == ENDEL:
+                yield element[0][1], element
+                element = None
+        elif rtype in ELEMENTS:
+            element = [rec]
+        else:
+            yield rtype, [rec]
+
+
+def element_info(element: list) -> tuple:
+    """Return the (layer, datatype) or the referenced structure name of an element"""
+    rtype = element[0][1]
+    if rtype in (SREF, AREF):
+        for rec in element:
+            if rec[1] == SNAME:
+                return parse_string(rec[3])
+        return None
+    layer = dtype = 0
+    for rec in element:
+        if rec[1] == LAYER:
+            layer = parse_int2(rec[3])[0]
+        elif rec[1] == ELEMENTS[rtype]:
+            dtype = parse_int2(rec[3])[0]
+    return layer, dtype
+
+
+def pack_record(rtype: int, dtype: int, payload: bytes = b'') -> bytes:
+    """Serialize a single record"""
+    if len(payload) % 2:
+        payload += b'\0'
+    return struct.pack('>HBB', len(payload) + 4, rtype, dtype) + payload
+
+
+def parse_int2(payload: bytes) -> array:
+    """Decode 2-byte signed integers"""
+    res = array('h', payload)
+    res.byteswap()
+    return res
+
+
+def pack_int2(values) -> bytes:
+    """Encode 2-byte signed integers"""
+    res = array('h', values)
+    res.byteswap()
+    return res.tobytes()
+
+
+def parse_int4(payload: bytes) -> array:
+    """Decode 4-byte signed integers"""
+    res = array('i', payload)
+    res.byteswap()
+    return res
+
+
+def pack_int4(values) -> bytes:
+    """Encode 4-byte signed integers"""
+    res = array('i', values)
+    res.byteswap()
+    return res.tobytes()
+
+
+def parse_real8(payload: bytes) -> list:
+    """Decode 8-byte excess-64 base-16 reals"""
+    res = []
+    for (word, ) in struct.iter_unpack('>Q', payload):
+        sign = -1.0 if word >> 63 else 1.0
+        exponent = (word >> 56) & 0x7f
+        mantissa = word & 0x00ffffffffffffff
+        res.append(sign * mantissa / 2.0**56 * 16.0**(exponent - 64))
+    return res
+
+
+def parse_string(payload: bytes) -> str:
+    """Decode a (possibly zero-padded) ASCII string"""
+    return payload.rstrip(b'\0').decode('ascii', errors='replace')
+
+
+class GzipMemberReader:
+    """Decompress a (multi-member) gzip stream and record where each member starts"""
+
+    def __init__(self, raw, chunk_size: int = CHUNK_SIZE):
+        self.raw = raw
+        self.chunk_size = chunk_size
+        self.members = [(0, 0)]
+        self._dec = zlib.decompressobj(31)
+        self._pending = b''
+        self._c_pos = 0
+        self._u_pos = 0
+        self._done = False
+
+    def read(self, size: int) -> bytes:
+        out = bytearray()
+        while len(out) < size and not self._done:
+            if not self._pending:
+                self._pending = self.raw.read(self.chunk_size)
+                if not self._pending:
+                    self._done = True
+                    break
+
+            data = self._pending
+            chunk = self._dec.decompress(data, size - len(out))
+            out += chunk
+            self._u_pos += len(chunk)
+            rest = self._dec.unconsumed_tail or self._dec.unused_data
+            self._c_pos += len(data) - len(rest)
+            self._pending = rest
+
+            # a member ended, a new one may follow (ignore trailing padding)
+            if self._dec.eof:
+                self._dec = zlib.decompressobj(31)
+                if self._pending[:2] not in (b'', b'\x1f\x8b'):
+                    self._done = True
+                else:
+                    self.members.append((self._u_pos, self._c_pos))
+
+        return bytes(out)
+
+    def block_table(self) -> list:
+        """Member start offsets (uncompressed, compressed), terminated by the end of the stream"""
+        table = [list(m) for m in self.members if m[0] < self._u_pos]
+        return table + [[self._u_pos, self._c_pos]]
+
+
+class BlockGzipWriter:
+    """Write a gzip stream as independent members of BLOCK_SIZE uncompressed bytes"""
+
+    def __init__(self, path: str, block_size: int = BLOCK_SIZE, level: int = 6):
+        self.file = open(path, 'wb')
+        self.block_size = block_size
+        self.level = level
+        self.blocks = []
+        self._pending = bytearray()
+        self._u_pos = 0
+
+    def write(self, data: bytes):
+        self._pending += data
+        while len(self._pending) >= self.block_size:
+            self._flush(self.block_size)
+
+    def _flush(self, size: int):
+        block = bytes(self._pending[:size])
+        del self._pending[:size]
+        self.blocks.append([self._u_pos, self.file.tell()])
+        self.file.write(gzip.compress(block, compresslevel=self.level, mtime=0))
+        self._u_pos += len(block)
+
+    def close(self) -> list:
+        """Flush, close and return the block table"""
+        if self._pending:
+            self._flush(len(self._pending))
+        self.blocks.append([self._u_pos, self.file.tell()])
+        self.file.close()
+        return self.blocks
+
+
+class TeeReader:
+    """Forward everything read from a stream to a writer"""
+
+    def __init__(self, stream, sink):
+        self.stream = stream
+        self.sink = sink
+
+    def read(self, size: int) -> bytes:
+        data = self.stream.read(size)
+        self.sink.write(data)
+        return data
+
+
+class RandomAccessReader:
+    """Read byte ranges of a plain or block-compressed GDS stream"""
+
+    def __init__(self, path: str, blocks: list = None):
+        self.file = open(path, 'rb')
+        self.blocks = blocks
+        if blocks:
+            self._starts = [b[0] for b in blocks]
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        if not self.blocks:
+            self.file.seek(offset)
+            return self.file.read(size)
+
+        # find the first block and decompress until the range is covered
+        idx = bisect.bisect_right(self._starts, offset) - 1
+        skip = offset - self._starts[idx]
+        out = bytearray()
+        while len(out) < skip + size and idx < len(self.blocks) - 1:
+            c_start, c_end = self.blocks[idx][1], self.blocks[idx + 1][1]
+            self.file.seek(c_start)
+            out += zlib.decompress(self.file.read(c_end - c_start), 31)
+            idx += 1
+        return bytes(out[skip:skip + size])
+
+    def close(self):
+        self.file.close()
@@ -7,18 +7,37 @@
 """Annotate the module outlines of a render"""
 
 import argparse
+import collections
 import colorsys
 import glob
+import gzip
 import json
+import multiprocessing
 import os
 import re
 import shutil
 import sys
 import tempfile
+from array import array
+import numpy as np
 from PIL import Image
 from PIL import ImageColor
 from svgpathtools import parse_path
 
+# version of the cached component table, bump on format changes
+TABLE_VERSION = 1
+
+# arrays of the component table, a cache missing any of them is stale
+TABLE_FIELDS = {'master', 'x', 'y', 'orient', 'path_offsets', 'path_segments', 'segments',
+                'masters', 'bbox'}
+
+# component orientations, stored by index in the component table
+ORIENTATIONS = ['N', 'S', 'E', 'W', 'FN', 'FS', 'FE', 'FW']
+ORIENT_IDS = {o.encode(): i for i, o in enumerate(ORIENTATIONS)}
+
+# bytes of the COMPONENTS section parsed at once
+CHUNK_SIZE = 1 << 24
+
 
 def parse_args() -> argparse.Namespace:
     """Parse and return command-line arguments for the DEF-to-SVG pipeline."""
@@ -33,6 +52,8 @@ def parse_args() -> argparse.Namespace:
                         help="Output merged SVG file")
     parser.add_argument("-b", "--background", required=True, type=os.path.abspath,
                         help="Rendered background bitmap image")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="Number of worker processes parsing the DEF file")
 
     # LEF information
     parser.add_argument("--lef_files", nargs="*", default=[],
@@ -111,141 +132,402 @@ def parse_lef_files(lef_file_paths: list) -> dict:
     return lef_cells
 
 
+def open_def(def_file_path: str):
+    """
+    Open a plain or gzipped DEF file for binary reading.
+    """
+
+    if def_file_path.endswith('.gz'):
+        return gzip.open(def_file_path, 'rb')
+    return open(def_file_path, 'rb')
+
+
+def component_chunks(def_file, chunk_size: int = CHUNK_SIZE):
+    """
+    Yield the rest of the COMPONENTS section in chunks of whole lines.
+    """
+
+    while True:
+        data = def_file.read(chunk_size)
+        if not data:
+            return
+        data += def_file.readline()
+        end = data.find(b'END COMPONENTS')
+        if end >= 0:
+            yield data[:end]
+            return
+        yield data
+
+
+def parse_component_chunk(data: bytes) -> dict:
+    """
+    Parse the component lines of a chunk into a table with chunk-local segment and master ids.
+    """
+
+    segment_ids = {}
+    master_ids = {}
+    path_segments = array('i')
+    path_offsets = array('q', [0])
+    columns = {'master': array('i'), 'x': array('i'), 'y': array('i'), 'orient': array('i')}
+
+    for line in data.split(b'\n'):
+        # - <path> <master> + PLACED ( <x> <y> ) <orientation> ;
+        cell = line.split()
+        if not cell or cell[0] != b'-':
+            continue
+        for seg in re.split(rb'\.|/', cell[1]):
+            path_segments.append(segment_ids.setdefault(seg, len(segment_ids)))
+        path_offsets.append(len(path_segments))
+        columns['master'].append(master_ids.setdefault(cell[2], len(master_ids)))
+        columns['x'].append(int(cell[-5]))
+        columns['y'].append(int(cell[-4]))
+        columns['orient'].append(ORIENT_IDS[cell[-2]])
+
+    table = {name: np.frombuffer(col, dtype=np.int32) for name, col in columns.items()}
+    table['segments'] = list(segment_ids)
+    table['masters'] = list(master_ids)
+    table['path_segments'] = np.frombuffer(path_segments, dtype=np.int32)
+    table['path_offsets'] = np.frombuffer(path_offsets, dtype=np.int64)
+    return table
+
+
+def merge_component_chunks(chunks: list, num_cells: int) -> dict:
+    """
+    Concatenate chunk tables in order, mapping their local ids to global ones.
+    """
+
+    segment_ids = {}
+    master_ids = {}
+    parts = {'path_segments': [], 'master': [], 'x': [], 'y': [], 'orient': []}
+    offsets = [np.zeros(1, dtype=np.int64)]
+    total = 0
+
+    for chunk in chunks:
+        seg_map = np.array([segment_ids.setdefault(seg, len(segment_ids))
+                            for seg in chunk['segments']], dtype=np.int32)
+        master_map = np.array([master_ids.setdefault(master, len(master_ids))
+                               for master in chunk['masters']], dtype=np.int32)
+        parts['path_segments'].append(seg_map[chunk['path_segments']])
+        parts['master'].append(master_map[chunk['master']])
+        for name in ('x', 'y', 'orient'):
+            parts[name].append(chunk[name])
+        offsets.append(chunk['path_offsets'][1:] + total)
+        total += len(chunk['path_segments'])
+
+    # only the declared number of components belongs to the section
+    table = {name: np.concatenate(part + [np.zeros(0, dtype=np.int32)])[:num_cells]
+             for name, part in parts.items() if name != 'path_segments'}
+    table['path_offsets'] = np.concatenate(offsets)[:num_cells + 1]
+    table['path_segments'] = np.concatenate(parts['path_segments'] + [
+        np.zeros(0, dtype=np.int32)])[:table['path_offsets'][-1]]
+    table['segments'] = np.array([seg.decode() for seg in segment_ids], dtype=str)
+    table['masters'] = np.array([master.decode() for master in master_ids], dtype=str)
+    return table
+
+
+def parse_def_components(def_file_path: str, jobs: int = 1) -> dict:
+    """
+    Parse the die area and the COMPONENTS section of a plain or gzipped DEF file into a
+    columnar table.
+
+    Instance paths are split into interned hierarchy segments, stored as segment ids with the
+    offsets of each path; master cells are interned likewise. The section is streamed in
+    chunks of whole lines, which are parsed by `jobs` worker processes.
+    """
+
+    SIZE_REGEX = r'\( *([0-9]+) *([0-9]+) *\) *\( *([0-9]+) *([0-9]+) *\)'
+
+    bbox = None
+    num_cells = None
+
+    with open_def(def_file_path) as def_file:
+        for line in def_file:
+            if line.startswith(b'DIEAREA'):
+                bbox = [int(s) for s in re.findall(SIZE_REGEX, line.decode())[0]]
+            elif line.startswith(b'COMPONENTS'):
+                num_cells = int(re.findall(r'[0-9]+', line.decode())[0])
+                break
+
+        if bbox is None or num_cells is None:
+            raise ValueError(f'No DIEAREA or COMPONENTS in {def_file_path}')
+
+        # keep a bounded number of chunks in flight while the file is read
+        if jobs <= 1:
+            chunks = [parse_component_chunk(data) for data in component_chunks(def_file)]
+        else:
+            chunks = []
+            pending = collections.deque()
+            with multiprocessing.Pool(jobs) as pool:
+                for data in component_chunks(def_file):
+                    pending.append(pool.apply_async(parse_component_chunk, (data, )))
+                    if len(pending) >= 2 * jobs:
+                        chunks.append(pending.popleft().get())
+                chunks.extend(res.get() for res in pending)
+
+    table = merge_component_chunks(chunks, num_cells)
+    table['bbox'] = np.array(bbox, dtype=np.int64)
+    return table
+
+
+def load_def_components(def_file_path: str, jobs: int = 1) -> dict:
+    """
+    Load the component table of a DEF file from the .npz next to it, parse it if stale.
+
+    The cache is keyed by the size and modification time of the DEF file; an unreadable or
+    incomplete cache is parsed again. It is written to a temporary file first and moved in
+    place, so an interrupted or concurrent run never leaves a truncated cache behind.
+    """
+
+    cache_path = f'{def_file_path}.npz'
+    stat = os.stat(def_file_path)
+    key = [TABLE_VERSION, stat.st_size, stat.st_mtime_ns]
+
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as cache:
+                if TABLE_FIELDS <= set(cache.files) and cache['key'].tolist() == key:
+                    table = {name: cache[name] for name in cache.files}
+                    print(f'Read component table from {cache_path}')
+                    return table
+        except Exception as err:
+            print(f'Ignoring the unreadable component table cache: {err}')
+
+    table = parse_def_components(def_file_path, jobs)
+    table['key'] = np.array(key, dtype=np.int64)
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(cache_path)),
+                                         suffix='.npz', delete=False) as tmp_file:
+            tmp_path = tmp_file.name
+            np.savez(tmp_file, **table)
+        os.replace(tmp_path, cache_path)
+        print(f'Cached component table in {cache_path}')
+    except OSError as err:
+        print(f'Could not cache the component table: {err}')
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return table
+
+
+def table_paths(table: dict):
+    """
+    Yield the hierarchy segments of each component's instance path.
+    """
+
+    segments = table['segments'].tolist()
+    offsets = table['path_offsets'].tolist()
+    path_segments = table['path_segments'].tolist()
+
+    for idx in range(len(offsets) - 1):
+        yield [segments[seg] for seg in path_segments[offsets[idx]:offsets[idx + 1]]]
+
+
+def cell_footprints(table: dict, lef_cells: dict, scale: int, y_size: int) -> tuple:
+    """
+    Return the pixel footprint (x, y, width, height) of each component.
+
+    A component covers x to x + width and y - height to y, inclusive; standard cells are
+    assumed a point, macros with a LEF size span it.
+    """
+
+    masters = table['masters'].tolist()
+    size_x = np.array([int(lef_cells[m][0] * 1000 / scale) if m in lef_cells else 0
+                       for m in masters], dtype=np.int64)
+    size_y = np.array([int(lef_cells[m][1] * 1000 / scale) if m in lef_cells else 0
+                       for m in masters], dtype=np.int64)
+    is_macro = np.array([m in lef_cells for m in masters], dtype=bool)[table['master']]
+
+    # rotated macros are drawn unrotated
+    for orient in np.unique(table['orient'][is_macro]).tolist():
+        if ORIENTATIONS[orient][-1] not in ['N', 'S']:
+            print(f'Orientation {ORIENTATIONS[orient][-1]} not supported')
+
+    xs = (table['x'] // scale).astype(np.int64)
+    ys = y_size - (table['y'] // scale).astype(np.int64)
+    return xs, ys, size_x[table['master']], size_y[table['master']]
+
+
+def rasterize_groups(groups: dict, footprints: tuple, x_size: int, y_size: int) -> dict:
+    """
+    Rasterize the components of each group into a boolean canvas cropped to the group.
+
+    Returns (x offset, y offset, canvas) per group; pixels outside the die are dropped.
+    """
+
+    xs, ys, ws, hs = footprints
+    canvases = {}
+
+    for group, cells in groups.items():
+        idx = np.frombuffer(cells, dtype=np.int64)
+        gx, gy, gw, gh = xs[idx], ys[idx], ws[idx], hs[idx]
+
+        # bounding box of the group, clipped to the die
+        x0 = max(int(gx.min()), 0)
+        y0 = max(int((gy - gh).min()), 0)
+        x1 = min(int((gx + gw).max()), x_size - 1)
+        y1 = min(int(gy.max()), y_size - 1)
+        canvas = np.zeros((max(y1 - y0 + 1, 0), max(x1 - x0 + 1, 0)), dtype=bool)
+
+        # standard cells, scattered
+        point = (gw == 0) & (gh == 0)
+        point &= (gx >= x0) & (gx <= x1) & (gy >= y0) & (gy <= y1)
+        canvas[gy[point] - y0, gx[point] - x0] = True
+
+        # macros, filled as rectangles
+        macro = (gw > 0) | (gh > 0)
+        for mx, my, mw, mh in zip(gx[macro].tolist(), gy[macro].tolist(),
+                                  gw[macro].tolist(), gh[macro].tolist()):
+            top, bottom = max(my - mh, y0), min(my, y1)
+            left, right = max(mx, x0), min(mx + mw, x1)
+            if top <= bottom and left <= right:
+                canvas[top - y0:bottom - y0 + 1, left - x0:right - x0 + 1] = True
+
+        canvases[group] = (x0, y0, canvas)
+
+    return canvases
+
+
 def parse_def_file_hier(def_file_path: str, scale: int, min_hier: int, max_hier: int,
-                        top_cell: str, lef_files: list) -> list:
+                        top_cell: str, lef_files: list, jobs: int = 1) -> list:
     """
-    Parse a DEF file, extract cell placements, and group them by truncated hierarchy path.
+    Parse a DEF file, group its cell placements by truncated hierarchy path, and rasterize
+    each group into a canvas.
     """
 
     lef_cells = parse_lef_files(lef_files)
+    table = load_def_components(def_file_path, jobs)
 
     groups = {}
-    pre_cells = True
-    bbox = None
-    x_size = y_size = 0
+    bbox = table['bbox'].tolist()
+    x_size = (bbox[2] - bbox[0]) // scale
+    y_size = (bbox[3] - bbox[1]) // scale
 
-    SIZE_REGEX = r'\( *([0-9]+) *([0-9]+) *\) *\( *([0-9]+) *([0-9]+) *\)'
+    for idx, sub_path in enumerate(table_paths(table)):
+        # iterate over hierarchies
+        for pl in range(min_hier, max_hier + 1):
+            sub_path_trunc = sub_path[:-1][:pl]
+            if len(sub_path_trunc) > pl - 1:
+                group = '.'.join(sub_path_trunc).replace('\\', '')
+                if group.startswith(top_cell):
 
-    with open(def_file_path, 'r') as def_file:
-        for line in def_file:
-            if pre_cells:
-                if line.startswith('DIEAREA'):
-                    bbox = [int(s) for s in re.findall(SIZE_REGEX, line)[0]]
-                    x_size = (bbox[2] - bbox[0]) // scale
-                    y_size = (bbox[3] - bbox[1]) // scale
-                elif line.startswith('COMPONENTS'):
-                    num_cells = int(re.findall(r'[0-9]+', line)[0])
-                    pre_cells = False
-            else:
-                # extract cell info
-                cell = line.split(' ')
-                path = cell[5]
-                master_cell_name = cell[6]
-                orientation = cell[-2][-1]
-                x_coord, y_coord = int(cell[-5]) // scale, y_size - (int(cell[-4]) // scale)
-
-                # get sub path
-                sub_path = re.split(r'\.|/', path)
-                # iterate over hierarchies
-                for pl in range(min_hier, max_hier + 1):
-                    sub_path_trunc = sub_path[:-1][:pl]
-                    if len(sub_path_trunc) > pl - 1:
-                        group = '.'.join(sub_path_trunc).replace('\\', '')
-                        if group.startswith(top_cell):
-
-                            # if group is new
-                            if group not in groups:
-                                groups[group] = []
-
-                            # check whether this is a special cell (with size)
-                            if master_cell_name in lef_cells:
-                                if orientation in ['N', 'S']:
-                                    pxs_x = int(lef_cells[master_cell_name][0] * 1000 / scale)
-                                    pxs_y = int(lef_cells[master_cell_name][1] * 1000 / scale)
-                                else:
-                                    print(f'Orientation {orientation} not supported')
-                                for x in range(0, pxs_x + 1):
-                                    for y in range(0, pxs_y + 1):
-                                        groups[group].append((x_coord + x, y_coord - y))
-
-                            # normal standard cell (assumed a point)
-                            else:
-                                groups[group].append((x_coord, y_coord))
-
-                num_cells -= 1
-                if num_cells == 0:
-                    break
-
-    return groups, x_size, y_size, bbox
-
-
-def parse_def_file_json(def_file_path: str, scale: int, modules: dict, lef_files: list) -> list:
-    """
-    Parse a DEF file, extract cell placements, and group them by truncated hierarchy path.
+                    # if group is new
+                    if group not in groups:
+                        groups[group] = array('q')
+
+                    groups[group].append(idx)
+
+    footprints = cell_footprints(table, lef_cells, scale, y_size)
+    return rasterize_groups(groups, footprints, x_size, y_size), x_size, y_size, bbox
+
+
+def build_automaton(patterns: list) -> dict:
+    """
+    Build an Aho-Corasick automaton finding all patterns as substrings in a single pass.
+
+    States are indices into the goto, fail, and out tables; out holds the pattern indices
+    found on reaching a state, including those of its suffixes.
+    """
+
+    goto = [{}]
+    fail = [0]
+    out = [set()]
+
+    # trie of all patterns
+    for idx, pattern in enumerate(patterns):
+        state = 0
+        for char in pattern:
+            if char not in goto[state]:
+                goto[state][char] = len(goto)
+                goto.append({})
+                fail.append(0)
+                out.append(set())
+            state = goto[state][char]
+        out[state].add(idx)
+
+    # failure links in breadth-first order, so shorter suffixes are done first
+    queue = collections.deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for char, nxt in goto[state].items():
+            queue.append(nxt)
+            fallback = fail[state]
+            while fallback and char not in goto[fallback]:
+                fallback = fail[fallback]
+            fail[nxt] = goto[fallback].get(char, 0)
+            out[nxt] |= out[fail[nxt]]
+
+    return {'goto': goto, 'fail': fail, 'out': [frozenset(o) for o in out]}
+
+
+def match_path(automaton: dict, sub_path: list, step_cache: dict) -> list:
+    """
+    Return the indices of all patterns found in the dot-joined path, in ascending order.
+
+    The automaton is advanced segment by segment; as instances share most of their hierarchy,
+    the transitions over whole segments are memoized in step_cache.
+    """
+
+    goto = automaton['goto']
+    fail = automaton['fail']
+    out = automaton['out']
+
+    state = 0
+    found = set(out[0])
+    for pos, seg in enumerate(sub_path):
+        text = seg if pos == 0 else '.' + seg
+        key = (state, text)
+        if key not in step_cache:
+            nxt = state
+            matches = set()
+            for char in text:
+                while nxt and char not in goto[nxt]:
+                    nxt = fail[nxt]
+                nxt = goto[nxt].get(char, 0)
+                matches |= out[nxt]
+            step_cache[key] = (nxt, frozenset(matches))
+        state, matches = step_cache[key]
+        found |= matches
+
+    return sorted(found)
+
+
+def parse_def_file_json(def_file_path: str, scale: int, modules: dict, lef_files: list,
+                        jobs: int = 1) -> list:
+    """
+    Parse a DEF file, group its cell placements by the modules they belong to, and rasterize
+    each group into a canvas.
     """
 
     lef_cells = parse_lef_files(lef_files)
+    table = load_def_components(def_file_path, jobs)
 
     groups = {}
-    pre_cells = True
-    bbox = None
-    x_size = y_size = 0
+    bbox = table['bbox'].tolist()
+    x_size = (bbox[2] - bbox[0]) // scale
+    y_size = (bbox[3] - bbox[1]) // scale
 
-    SIZE_REGEX = r'\( *([0-9]+) *([0-9]+) *\) *\( *([0-9]+) *([0-9]+) *\)'
+    # module names in order, matched through one automaton
+    names = [modules[tgt_module]['name'] for tgt_module in modules]
+    automaton = build_automaton(list(modules))
+    step_cache = {}
 
-    with open(def_file_path, 'r') as def_file:
-        for line in def_file:
-            if pre_cells:
-                if line.startswith('DIEAREA'):
-                    bbox = [int(s) for s in re.findall(SIZE_REGEX, line)[0]]
-                    x_size = (bbox[2] - bbox[0]) // scale
-                    y_size = (bbox[3] - bbox[1]) // scale
-                elif line.startswith('COMPONENTS'):
-                    num_cells = int(re.findall(r'[0-9]+', line)[0])
-                    pre_cells = False
-            else:
-                # extract cell info
-                cell = line.split(' ')
-                path = cell[5]
-                master_cell_name = cell[6]
-                orientation = cell[-2][-1]
-                x_coord, y_coord = int(cell[-5]) // scale, y_size - (int(cell[-4]) // scale)
-
-                # get sub path
-                sub_path = re.split(r'\.|/', path)
-                for tgt_module in modules:
-                    if tgt_module in '.'.join(sub_path):
-                        group = modules[tgt_module]['name']
-                        # if group is new
-                        if group not in groups:
-                            groups[group] = []
-
-                        # check whether this is a special cell (with size)
-                        if master_cell_name in lef_cells:
-                            if orientation in ['N', 'S']:
-                                pxs_x = int(lef_cells[master_cell_name][0] * 1000 / scale)
-                                pxs_y = int(lef_cells[master_cell_name][1] * 1000 / scale)
-                            else:
-                                print(f'Orientation {orientation} not supported')
-                            for x in range(0, pxs_x + 1):
-                                for y in range(0, pxs_y + 1):
-                                    groups[group].append((x_coord + x, y_coord - y))
-
-                        # normal standard cell (assumed a point)
-                        else:
-                            groups[group].append((x_coord, y_coord))
-
-                num_cells -= 1
-                if num_cells == 0:
-                    break
-
-    return groups, x_size, y_size, bbox
+    for idx, sub_path in enumerate(table_paths(table)):
+        for tgt_idx in match_path(automaton, sub_path, step_cache):
+            group = names[tgt_idx]
+            # if group is new
+            if group not in groups:
+                groups[group] = array('q')
+
+            groups[group].append(idx)
+
+    footprints = cell_footprints(table, lef_cells, scale, y_size)
+    return rasterize_groups(groups, footprints, x_size, y_size), x_size, y_size, bbox
 
 
 def generate_svgs(groups: dict, x_size: int, y_size: int, bbox: list, tmp_dir: str,
                   turd_size: int) -> list:
     """
-    Rasterize grouped cell placements to bitmaps and convert them to SVG using potrace.
+    Place the group canvases on die-sized bitmaps and convert them to SVG using potrace.
     """
 
     # point to pixel
@@ -254,10 +536,10 @@ def generate_svgs(groups: dict, x_size: int, y_size: int, bbox: list, tmp_dir: s
 
     path_svgs = []
 
-    for group, pixels in groups.items():
+    for group, (x0, y0, canvas) in groups.items():
         img = Image.new('1', (x_size, y_size), 1)
-        for px in pixels:
-            img.putpixel(px, 0)
+        if canvas.size:
+            img.paste(Image.fromarray(~canvas), (x0, y0))
 
         bmp_path = f"{tmp_dir}/{group}.bmp"
         svg_path = f"{tmp_dir}/{group}.svg"
@@ -408,12 +690,13 @@ def main() -> None:
         with open(args.module_json, 'r') as jf:
             module_data = json.load(jf)
         groups, x_size, y_size, bbox = parse_def_file_json(args.def_file, args.px_scale,
-                                                           module_data, args.lef_files)
+                                                           module_data, args.lef_files,
+                                                           args.jobs)
     else:
         module_data = None
         groups, x_size, y_size, bbox = parse_def_file_hier(args.def_file, args.px_scale, args.min,
                                                            args.max, args.top_instance,
-                                                           args.lef_files)
+                                                           args.lef_files, args.jobs)
 
     # create a temp dir used to store the intermittent files
     with tempfile.TemporaryDirectory() as tmp_dir:
@@ -11,11 +11,16 @@
 
 import sys
 import argparse
+import warnings
+import multiprocessing
 import gdspy
 import numpy as np
 
 from PIL import Image
 
+from density import window_density as window_density
+from raster import coverage as coverage
+
 # constant for the database unit
 # DB units
 DB2NM = 2000.0
@@ -78,161 +83,938 @@ HORDW = [[-1, -1, -1, -1],
 KERNELS = [FULL, EMPTY, UPLF, UPRG, LWLF, LWRG, VERLF, VERRG, HORUP, HORDW]
 
 
-# Create primitive GDS cells which corresponds to the dithering pattern
-cell_full = gdspy.Cell(name='full').add(
-                gdspy.Rectangle((0, 0), (2*PIXSZ, 2*PIXSZ), layer=0))
-cell_quater = gdspy.Cell(name='quater').add(
-                gdspy.Rectangle((0, 0), (1*PIXSZ, 1*PIXSZ), layer=0))
-cell_vert = gdspy.Cell(name='vert').add(
-                gdspy.Rectangle((0, 0), (1*PIXSZ, 2*PIXSZ), layer=0))
-cell_horiz = gdspy.Cell(name='horiz').add(
-                gdspy.Rectangle((0, 0), (2*PIXSZ, 1*PIXSZ), layer=0))
-
-
-# Define primitive functions that reference dither primitives
-def full_box(cell: gdspy.Cell, row: int, col: int):
-    """Full box"""
-    cell.add(gdspy.CellReference(cell_full, origin=(col*PIXSZ, -row*PIXSZ)))
-
-
-def empty_box(cell: gdspy.Cell, row: int, col: int):
-    """Empty box"""
-
-
-def uplf_box(cell: gdspy.Cell, row: int, col: int):
-    """1/4 block, upper left"""
-    cell.add(gdspy.CellReference(cell_quater, origin=(col*PIXSZ, -(row-1)*PIXSZ)))
-
-
-def uprg_box(cell: gdspy.Cell, row: int, col: int):
-    """1/4 block, upper right"""
-    cell.add(gdspy.CellReference(cell_quater, origin=((col+1)*PIXSZ, -(row-1)*PIXSZ)))
-
-
-def lwlf_box(cell: gdspy.Cell, row: int, col: int):
-    """1/4 block, lower left"""
-    cell.add(gdspy.CellReference(cell_quater, origin=(col*PIXSZ, -row*PIXSZ)))
+# Footprint of the primitive of each kernel: (width, height, column offset, row offset) in
+# pixels; a primitive covers the rows row + row offset - height + 1 to row + row offset
+PRIMITIVES = [(2, 2, 0, 0), (0, 0, 0, 0),
+              (1, 1, 0, -1), (1, 1, 1, -1), (1, 1, 0, 0), (1, 1, 1, 0),
+              (1, 2, 0, 0), (1, 2, 1, 0), (2, 1, 0, -1), (2, 1, 0, 0)]
 
+# Next smaller and next larger primitive, covering a subset or a superset of the footprint
+DOWNGRADE = [9, 1, 1, 1, 1, 1, 4, 5, 2, 4]
+UPGRADE = [0, 4, 8, 8, 9, 9, 0, 0, 0, 0]
 
-def lwrg_box(cell: gdspy.Cell, row: int, col: int):
-    """1/4 block, lower right"""
-    cell.add(gdspy.CellReference(cell_quater, origin=((col+1)*PIXSZ, -row*PIXSZ)))
+# Violating density windows listed by the report, worst first
+REPORT_VIOLATIONS = 10
 
+# Colors of the raster preview
+PREVIEW_COLORS = {'background': (255, 255, 255), 'logo': (218, 165, 32),
+                  'blocked': (244, 166, 166), 'metal': (96, 96, 96)}
 
-def verlf_box(cell: gdspy.Cell, row: int, col: int):
-    """1/2 block, vertical left"""
-    cell.add(gdspy.CellReference(cell_vert, origin=(col*PIXSZ, -row*PIXSZ)))
 
+def selection_grid(logo_image: np.ndarray) -> np.ndarray:
+    """Find the most suitable dithering primitive of each window, in one batched operation
 
-def verrg_box(cell: gdspy.Cell, row: int, col: int):
-    """1/2 block, vertical right"""
-    cell.add(gdspy.CellReference(cell_vert, origin=((col+1)*PIXSZ, -row*PIXSZ)))
+    Windows of KERNEL_DIM pixels are placed with a stride of KERNEL_DIM - 1 and correlated
+    with all KERNELS at once; ties select the first kernel.
+    """
+    stride = KERNEL_DIM - 1
+    # windows must end before the last row and column
+    windows = np.lib.stride_tricks.sliding_window_view(
+        logo_image[:-1, :-1].astype(np.int32), (KERNEL_DIM, KERNEL_DIM))[::stride, ::stride]
+    kernels = np.array(KERNELS, dtype=np.int32)
+    return np.argmax(np.einsum('rcij,kij->rck', windows, kernels), axis=-1)
 
 
-def horup_box(cell: gdspy.Cell, row: int, col: int):
-    """1/2 block, horizontal up"""
-    cell.add(gdspy.CellReference(cell_horiz, origin=(col*PIXSZ, -(row-1)*PIXSZ)))
+def grid_primitives(sel: np.ndarray) -> tuple:
+    """Arrays (primitive, row, col) of all windows not selecting the empty primitive"""
+    stride = KERNEL_DIM - 1
+    rows, cols = np.nonzero(sel != KERNELS.index(EMPTY))
+    return sel[rows, cols], rows * stride, cols * stride
 
 
-def hordw_box(cell: gdspy.Cell, row: int, col: int):
-    """1/2 block, horizontal up"""
-    cell.add(gdspy.CellReference(cell_horiz, origin=(col*PIXSZ, -row*PIXSZ)))
+def select_primitives(logo_image: np.ndarray) -> tuple:
+    return grid_primitives(selection_grid(logo_image))
 
 
-# list of the primitive functions
-FUNCS = [full_box, empty_box, uplf_box, uprg_box, lwlf_box,
-         lwrg_box, verlf_box, verrg_box, horup_box, hordw_box]
+def read_rows(image: Image.Image, top: int, bottom: int, contrast: float) -> np.ndarray:
+    """Pre-processed rows top to bottom of a 1-bit image, dark pixels are positive"""
+    rows = np.array(image.crop((0, top, image.width, bottom)), dtype=np.int32)
+    return 255 - rows * 255 - int(255 * contrast)
+
+
+def footprint(prim: int, row: int, col: int) -> set:
+    """Canvas pixels (row, col) of a primitive"""
+    width, height, d_col, d_row = PRIMITIVES[prim]
+    return {(row + d_row - dy + 1, col + d_col + dx) for dy in range(height) for dx in range(width)}
+
+
+def primitive_canvas(prim: np.ndarray, row: np.ndarray, col: np.ndarray,
+                     shape: tuple) -> np.ndarray:
+    """Union of the selected primitives on the pixel grid
+
+    Canvas row r covers the image row r - 1, the extra row on top takes primitives of row 0.
+    """
+    canvas = np.zeros((shape[0] + 1, shape[1]), dtype=bool)
+    for idx, (width, height, d_col, d_row) in enumerate(PRIMITIVES):
+        sel = prim == idx
+        for dy in range(height):
+            for dx in range(width):
+                canvas[row[sel] + d_row - dy + 1, col[sel] + d_col + dx] = True
+    return canvas
+
+
+def primitive_rectangles(prim: np.ndarray, row: np.ndarray, col: np.ndarray) -> np.ndarray:
+    """Footprints (x0, x1, r0, r1) of the primitives in canvas columns and rows, ends exclusive
+
+    Footprints of neighbouring windows are always one pixel apart, so each is one rectangle.
+    """
+    width, height, d_col, d_row = np.array(PRIMITIVES, dtype=np.int64)[prim].T
+    r1 = row + d_row + 2
+    return np.stack([col + d_col, col + d_col + width, r1 - height, r1],
+                    axis=-1).reshape(-1, 4)
+
+
+def canvas_rectangles(canvas: np.ndarray) -> np.ndarray:
+    """Decompose a canvas into rectangles (x0, x1, r0, r1) of columns and rows, ends exclusive
+
+    Set pixels are merged into runs per row, runs with the same extent in consecutive rows
+    are merged vertically.
+    """
+    edges = np.diff(np.pad(canvas, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    r, x0 = np.nonzero(edges == 1)
+    _, x1 = np.nonzero(edges == -1)
+
+    # a run extends the rectangle of its predecessor if it continues it in the row above
+    order = np.lexsort((r, x1, x0))
+    r, x0, x1 = r[order], x0[order], x1[order]
+    new = np.ones(len(r), dtype=bool)
+    new[1:] = (x0[1:] != x0[:-1]) | (x1[1:] != x1[:-1]) | (r[1:] != r[:-1] + 1)
+    first = np.nonzero(new)[0]
+    if len(first) == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+    last = np.append(first[1:], len(r)) - 1
+    return np.stack([x0[first], x1[first], r[first], r[last] + 1], axis=-1)
+
+
+def logo_rectangles(prim: np.ndarray, row: np.ndarray, col: np.ndarray,
+                    keep_out: np.ndarray = None) -> np.ndarray:
+    """Rectangles of the selected primitives, cleared of the canvas pixels in `keep_out`
+
+    Primitives clear of the keep-out are their footprint; the free pixels of the others are
+    decomposed into rectangles.
+    """
+    rects = primitive_rectangles(prim, row, col)
+    if keep_out is None or len(rects) == 0:
+        return rects
+
+    sums = np.pad(np.cumsum(np.cumsum(keep_out, axis=0, dtype=np.int64), axis=1), ((1, 0), (1, 0)))
+    x0, x1, r0, r1 = rects.T
+    blocked = sums[r1, x1] - sums[r0, x1] - sums[r1, x0] + sums[r0, x0] > 0
+    canvas = primitive_canvas(prim[blocked], row[blocked], col[blocked],
+                              (keep_out.shape[0] - 1, keep_out.shape[1])) & ~keep_out
+    return np.concatenate([rects[~blocked], canvas_rectangles(canvas)])
+
+
+def rectangle_corners(rects: np.ndarray, canvas_box: list, top: int = 0) -> np.ndarray:
+    """Corners of canvas rectangles in chip coordinates, ordered as returned by the boolean
+
+    `top` is the canvas row the rows of the rectangles are counted from.
+    """
+    x_lo = canvas_box[0] + rects[:, 0] * PIXSZ
+    x_hi = canvas_box[0] + rects[:, 1] * PIXSZ
+    y_lo = canvas_box[3] - (rects[:, 3] + top) * PIXSZ
+    y_hi = canvas_box[3] - (rects[:, 2] + top) * PIXSZ
+    return np.stack([np.stack([x_hi, y_hi], axis=-1), np.stack([x_lo, y_hi], axis=-1),
+                     np.stack([x_lo, y_lo], axis=-1), np.stack([x_hi, y_lo], axis=-1)], axis=1)
+
+
+def polygon_coverage(polygons: list, box: list, shape: tuple) -> np.ndarray:
+    """Area coverage of the pixels of a grid (first row on top) by possibly overlapping polygons
+
+    Polygons of either orientation are rasterized separately so their winding adds up.
+    """
+    res = np.zeros((shape[1], shape[0]), dtype=np.float32)
+    if polygons:
+        vertices = np.concatenate(polygons)
+        lengths = np.array([len(poly) for poly in polygons])
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        nxt = np.arange(1, len(vertices) + 1)
+        nxt[offsets[1:] - 1] = offsets[:-1]
+        cross = vertices[:, 0] * vertices[nxt, 1] - vertices[nxt, 0] * vertices[:, 1]
+        ccw = np.add.reduceat(cross, offsets[:-1]) > 0
+        for sel in (ccw, ~ccw):
+            part = vertices[np.repeat(sel, lengths)]
+            part_offsets = np.concatenate([[0], np.cumsum(lengths[sel])])
+            res += coverage([(part, part_offsets)], box, shape)
+    return np.minimum(res, 1.0)
+
+
+def polygon_touched(polygons: list, box: list, shape: tuple,
+                    area: np.ndarray = None) -> np.ndarray:
+    """Pixels of a grid (first row on top) whose interior any of the polygons overlaps
+
+    A pixel is touched if an edge crosses it or, away from edges, if its coverage is above one
+    half; the approximate coverage of slanted edges is never thresholded. `area` is the
+    `polygon_coverage` of the polygons if already known.
+
+    A 45 degree edge marks every pixel it crosses:
+
+    >>> polygon_touched([np.array([[0, 0], [3, 0], [0, 3]])], [0, 0, 4, 4], (4, 4)).astype(int)
+    array([[0, 0, 0, 0],
+           [1, 0, 0, 0],
+           [1, 1, 0, 0],
+           [1, 1, 1, 0]])
+    """
+    if area is None:
+        area = polygon_coverage(polygons, box, shape)
+    res = area > 0.5
+    if not polygons:
+        return res
+
+    # edges in pixel units, x right and y up, snapped onto nearby grid lines
+    width, height = shape
+    vertices = np.concatenate(polygons).astype(np.float64)
+    lengths = np.array([len(poly) for poly in polygons])
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    nxt = np.arange(1, len(vertices) + 1)
+    nxt[offsets[1:] - 1] = offsets[:-1]
+    pts = (vertices - [box[0], box[1]]) / [(box[2] - box[0]) / width, (box[3] - box[1]) / height]
+    pts = np.where(np.abs(pts - np.rint(pts)) < 1e-6, np.rint(pts), pts)
+    p0, p1 = pts, pts[nxt]
+
+    # rows whose interior an edge reaches, horizontal edges on a grid line reach none
+    y_lo = np.minimum(p0[:, 1], p1[:, 1])
+    y_hi = np.maximum(p0[:, 1], p1[:, 1])
+    r0 = np.maximum(np.floor(y_lo).astype(np.int64), 0)
+    r1 = np.minimum(np.ceil(y_hi).astype(np.int64) - 1, height - 1)
+    rows = np.maximum(r1 - r0 + 1, 0)
+    idx = np.repeat(np.arange(len(p0)), rows)
+    r = np.repeat(r0, rows) + np.arange(len(idx)) - np.repeat(np.cumsum(rows) - rows, rows)
+
+    # x extent of each edge within each of its rows
+    a, b = p0[idx], p1[idx]
+    dy = b[:, 1] - a[:, 1]
+    flat = dy == 0
+    ya = np.clip(r, y_lo[idx], y_hi[idx])
+    yb = np.clip(r + 1, y_lo[idx], y_hi[idx])
+    t = np.where(flat, 0.0, 1.0 / np.where(flat, 1.0, dy))
+    xa = np.where(flat, a[:, 0], a[:, 0] + (ya - a[:, 1]) * (b[:, 0] - a[:, 0]) * t)
+    xb = np.where(flat, b[:, 0], a[:, 0] + (yb - a[:, 1]) * (b[:, 0] - a[:, 0]) * t)
+    x_lo = np.where(np.abs(xa - np.rint(xa)) < 1e-6, np.rint(xa), xa)
+    x_hi = np.where(np.abs(xb - np.rint(xb)) < 1e-6, np.rint(xb), xb)
+    x_lo, x_hi = np.minimum(x_lo, x_hi), np.maximum(x_lo, x_hi)
+
+    # columns whose interior the edge reaches, marked as runs of a difference array per row
+    c0 = np.maximum(np.floor(x_lo).astype(np.int64), 0)
+    c1 = np.minimum(np.ceil(x_hi).astype(np.int64) - 1, width - 1)
+    run = c0 <= c1
+    row = (height - 1 - r[run]) * (width + 1)
+    diff = np.bincount(np.concatenate([row + c0[run], row + c1[run] + 1]),
+                       weights=np.repeat([1.0, -1.0], np.count_nonzero(run)),
+                       minlength=height * (width + 1))
+    res |= np.cumsum(diff.reshape(height, width + 1), axis=1)[:, :width] > 0.5
+    return res
+
+
+def metal_keep_out(touched: np.ndarray) -> np.ndarray:
+    """Pixels touching metal or next to a pixel touching metal
+
+    The one-pixel spacing of the polygon mask is a cross-shaped dilation on the pixel grid.
+    """
+    blocked = touched.copy()
+    blocked[1:] |= touched[:-1]
+    blocked[:-1] |= touched[1:]
+    blocked[:, 1:] |= touched[:, :-1]
+    blocked[:, :-1] |= touched[:, 1:]
+    return blocked
+
+
+def metal_raster(metal: list, bbox: np.ndarray) -> tuple:
+    """Pixels touching metal on the grid of PIXSZ around the chip, and the box of the grid"""
+    box = [np.floor(bbox[0][0] / PIXSZ) * PIXSZ, np.floor(bbox[0][1] / PIXSZ) * PIXSZ,
+           np.ceil(bbox[1][0] / PIXSZ) * PIXSZ, np.ceil(bbox[1][1] / PIXSZ) * PIXSZ]
+    shape = (round((box[2] - box[0]) / PIXSZ), round((box[3] - box[1]) / PIXSZ))
+    return polygon_touched(metal, box, shape), box
+
+
+def raster_window(raster: np.ndarray, raster_box: list, box: list) -> np.ndarray:
+    """Pixels of a box cut from a raster of `raster_box`, None if the box is off its grid"""
+    col = (box[0] - raster_box[0]) / PIXSZ
+    row = (raster_box[3] - box[3]) / PIXSZ
+    if abs(col - round(col)) > 1e-6 or abs(row - round(row)) > 1e-6:
+        return None
+    col, row = round(col), round(row)
+    res = np.zeros((round((box[3] - box[1]) / PIXSZ), round((box[2] - box[0]) / PIXSZ)),
+                   dtype=bool)
+
+    # off the raster there is no metal
+    r0, r1 = max(row, 0), min(row + res.shape[0], raster.shape[0])
+    c0, c1 = max(col, 0), min(col + res.shape[1], raster.shape[1])
+    if r0 < r1 and c0 < c1:
+        res[r0 - row:r1 - row, c0 - col:c1 - col] = raster[r0:r1, c0:c1]
+    return res
+
+
+def canvas_metal(metal: list, boxes: np.ndarray, canvas_box: list, width: int, top: int,
+                 bottom: int, touched: tuple = None) -> np.ndarray:
+    """Pixels touching metal of the rows top to bottom of a canvas `width` pixels wide
+
+    Only the metal polygons with their bounding `boxes` near the rows are rasterized. The
+    pixels are cut from the `touched` raster and its box instead if the canvas is on its grid.
+    """
+    box = [canvas_box[0], canvas_box[3] - bottom * PIXSZ,
+           canvas_box[2], canvas_box[3] - top * PIXSZ]
+    res = None if touched is None else raster_window(*touched, box)
+    if res is None:
+        near = np.nonzero((boxes[:, 0] < box[2]) & (boxes[:, 2] > box[0]) &
+                          (boxes[:, 1] < box[3]) & (boxes[:, 3] > box[1]))[0]
+        res = polygon_touched([metal[i] for i in near], box, (width, bottom - top))
+    return res
+
+
+def canvas_keep_out(metal: list, boxes: np.ndarray, canvas_box: list, shape: tuple,
+                    top: int, bottom: int, touched: tuple = None) -> np.ndarray:
+    """Keep-out of the rows top to bottom of a canvas of `shape` (width, rows) pixels
+
+    The metal is rasterized with one pixel of margin on all sides, also beyond the canvas, so
+    metal next to the rows or the canvas blocks its neighboring pixels.
+    """
+    margin_box = [canvas_box[0] - PIXSZ, canvas_box[1], canvas_box[2] + PIXSZ, canvas_box[3]]
+    metal_touched = canvas_metal(metal, boxes, margin_box, shape[0] + 2, top - 1, bottom + 1,
+                                 touched)
+    return metal_keep_out(metal_touched)[1:-1, 1:-1]
+
+
+def preview_image(canvas: np.ndarray, touched: np.ndarray, scale: float) -> Image.Image:
+    """Canvas pixels kept as logo, blocked by metal, and touching metal in PREVIEW_COLORS"""
+    blocked = metal_keep_out(touched)
+    rgb = np.empty(canvas.shape + (3, ), dtype=np.uint8)
+    rgb[...] = PREVIEW_COLORS['background']
+    rgb[blocked] = PREVIEW_COLORS['blocked']
+    rgb[touched] = PREVIEW_COLORS['metal']
+    rgb[canvas & ~blocked] = PREVIEW_COLORS['logo']
+
+    img = Image.fromarray(rgb)
+    if scale != 1.0:
+        size = (max(round(img.width * scale), 1), max(round(img.height * scale), 1))
+        img = img.resize(size, Image.NEAREST if scale > 1.0 else Image.BOX)
+    return img
+
+
+def image_canvas(image: Image.Image, contrast: float, band_rows: int = 1024) -> np.ndarray:
+    """Primitive canvas of a whole image without keep-out, selected in bands of window rows"""
+    stride = KERNEL_DIM - 1
+    img_width, img_height = image.size
+    grid_rows = (img_height - 1 - KERNEL_DIM) // stride + 1
+    canvas = np.zeros((img_height + 1, img_width), dtype=bool)
+    for first in range(0, grid_rows, band_rows):
+        top, bottom = first * stride, min(first + band_rows, grid_rows) * stride
+        logo_image = read_rows(image, top, min(bottom + KERNEL_DIM - stride + 1, img_height),
+                               contrast)
+        canvas[top:bottom] = primitive_canvas(*select_primitives(logo_image),
+                                              (bottom - top - 1, img_width))
+    return canvas
+
+
+def placement_overlap(canvas: np.ndarray, blocked: np.ndarray) -> np.ndarray:
+    """Canvas pixels on blocked pixels for each offset (row, col) of the canvas within `blocked`
+
+    All offsets are scored at once by a cross-correlation in the frequency domain; offsets
+    never wrap around as the canvas stays within `blocked`.
+    """
+    shape = blocked.shape
+    spectrum = np.fft.rfft2(blocked.astype(np.float64)) * \
+        np.conj(np.fft.rfft2(canvas.astype(np.float64), shape))
+    overlap = np.fft.irfft2(spectrum, shape)
+    return np.rint(overlap[:shape[0] - canvas.shape[0] + 1,
+                           :shape[1] - canvas.shape[1] + 1]).astype(np.int64)
+
+
+def best_offset(overlap: np.ndarray) -> tuple:
+    """Offset of the least overlap, ties are resolved towards the center"""
+    rows, cols = np.nonzero(overlap == overlap.min())
+    dist = (rows - (overlap.shape[0] - 1) / 2)**2 + (cols - (overlap.shape[1] - 1) / 2)**2
+    idx = np.argmin(dist)
+    return rows[idx], cols[idx]
+
+
+def polygon_bboxes(polygons: list) -> np.ndarray:
+    """Bounding boxes (left, bottom, right, top) of a list of polygons"""
+    if not polygons:
+        return np.zeros((0, 4))
+    vertices = np.concatenate(polygons)
+    starts = np.concatenate([[0], np.cumsum([len(poly) for poly in polygons])[:-1]])
+    return np.stack([np.minimum.reduceat(vertices[:, 0], starts),
+                     np.minimum.reduceat(vertices[:, 1], starts),
+                     np.maximum.reduceat(vertices[:, 0], starts),
+                     np.maximum.reduceat(vertices[:, 1], starts)], axis=-1)
+
+
+def metal_mask(metal: list, boxes: np.ndarray = None) -> tuple:
+    """Metal grown by one pixel as five shifted copies of each polygon, with their boxes"""
+    if boxes is None:
+        boxes = polygon_bboxes(metal)
+    shifts = [(0, 0), (-PIXSZ, 0), (PIXSZ, 0), (0, -PIXSZ), (0, PIXSZ)]
+    mask = [poly + shift for shift in shifts for poly in metal]
+    mask_boxes = np.concatenate([boxes + [dx, dy, dx, dy] for dx, dy in shifts])
+    return mask, mask_boxes
+
+
+def clip_bin(rects: list, mask: list, layer: int, datatype: int) -> list:
+    """Subtract the mask polygons from the logo rectangles of a bin"""
+    if not mask:
+        return rects
+    res = gdspy.boolean(rects, mask, operation='not', layer=layer, datatype=datatype)
+    return [] if res is None else res.polygons
+
+
+def tiled_boolean(corners: np.ndarray, metal: list, bins: int, jobs: int,
+                  layer: int, datatype: int, mask: tuple = None) -> list:
+    """Subtract the metal, grown by one pixel, from the logo rectangles bin by bin
+
+    Each rectangle belongs to the bin of its center, and each bin only considers the mask
+    polygons overlapping its rectangles. Bins are clipped in parallel and, as they share no
+    rectangle, their results are simply concatenated. The `mask` of `metal_mask` is built
+    from the metal near the logo unless given.
+    """
+    if len(corners) == 0:
+        return []
+    lo = corners.min(axis=1)
+    hi = corners.max(axis=1)
+
+    # mask polygons near the logo, shifted by one pixel to all sides
+    if mask is None:
+        boxes = polygon_bboxes(metal)
+        near = np.nonzero((boxes[:, 0] < hi[:, 0].max() + PIXSZ) &
+                          (boxes[:, 2] > lo[:, 0].min() - PIXSZ) &
+                          (boxes[:, 1] < hi[:, 1].max() + PIXSZ) &
+                          (boxes[:, 3] > lo[:, 1].min() - PIXSZ))[0]
+        mask = metal_mask([metal[i] for i in near], boxes[near])
+    mask, mask_boxes = mask
+
+    # bin of each rectangle on a grid over the logo
+    origin = lo.min(axis=0)
+    size = (hi.max(axis=0) - origin) / bins
+    index = np.clip(((lo + hi) / 2 - origin) // size, 0, bins - 1).astype(np.int64)
+    key = index[:, 1] * bins + index[:, 0]
+
+    tasks = []
+    for b in np.unique(key):
+        sel = key == b
+        b_lo = lo[sel].min(axis=0)
+        b_hi = hi[sel].max(axis=0)
+        hit = np.nonzero((mask_boxes[:, 0] < b_hi[0]) & (mask_boxes[:, 2] > b_lo[0]) &
+                         (mask_boxes[:, 1] < b_hi[1]) & (mask_boxes[:, 3] > b_lo[1]))[0]
+        tasks.append((list(corners[sel]), [mask[i] for i in hit], layer, datatype))
+
+    if jobs <= 1:
+        results = [clip_bin(*task) for task in tasks]
+    else:
+        with multiprocessing.Pool(jobs) as pool:
+            results = pool.starmap(clip_bin, tasks)
+    return [poly for res in results for poly in res]
+
+
+def clean_polygons(polygons: list) -> np.ndarray:
+    """Stacked corners (n, 4, 2) of the clipped polygons with four vertices and sides of DB2NM
+
+    All polygons are checked at once. The sides are measured from the first vertex in the
+    order of the boolean, polygons of other vertex counts are rejected.
+    """
+    lengths = np.array([len(poly) for poly in polygons], dtype=np.int64)
+    for idx in np.nonzero(lengths != 4)[0]:
+        print(f'Reject {polygons[idx]} as it has {lengths[idx]} points')
+    if np.all(lengths == 4):
+        quads = np.asarray(polygons, dtype=np.float64).reshape(-1, 4, 2)
+    else:
+        quads = np.array([polygons[idx] for idx in np.nonzero(lengths == 4)[0]],
+                         dtype=np.float64).reshape(-1, 4, 2)
+
+    p_height = quads[:, 0, 0] - quads[:, 1, 0]
+    p_width = quads[:, 0, 1] - quads[:, 3, 1]
+    return quads[(p_height >= DB2NM) & (p_width >= DB2NM)]
+
+
+def axis_parallel(quads: np.ndarray) -> np.ndarray:
+    """Mask of the stacked quadrilaterals (n, 4, 2) which are axis-parallel rectangles"""
+    edges = np.roll(quads, -1, axis=1) - quads
+    return np.all((edges[..., 0] == 0) | (edges[..., 1] == 0), axis=1)
+
+
+def polygon_areas(vertices: np.ndarray) -> np.ndarray:
+    """Areas of stacked polygons (n, k, 2) of k vertices each, using the shoelace formula"""
+    nxt = np.roll(vertices, -1, axis=1)
+    cross = vertices[..., 0] * nxt[..., 1] - nxt[..., 0] * vertices[..., 1]
+    return np.abs(cross.sum(axis=1)) / 2.0
+
+
+def array_cells(polygons: list, name: str, layer: int, datatype: int) -> list:
+    """Express rectangles as references and arrays of one cell per rectangle size
+
+    Rectangles of a size are sorted by row; runs at a constant pitch within a row become one
+    array, and runs of equal position, length, and pitch in rows at a constant pitch are
+    stacked into two-dimensional arrays.
+    """
+    if len(polygons) == 0:
+        return []
+    points = np.array(polygons)
+    lo = np.rint(points.min(axis=1)).astype(np.int64)
+    size = np.rint(points.max(axis=1)).astype(np.int64) - lo
+
+    res = []
+    for width, height in np.unique(size, axis=0).tolist():
+        cell = gdspy.Cell(name=f'{name}_rect_{width}x{height}', exclude_from_current=True).add(
+                   gdspy.Rectangle((0, 0), (width, height), layer=layer, datatype=datatype))
+        sel = np.all(size == (width, height), axis=1)
+        order = np.lexsort((lo[sel, 0], lo[sel, 1]))
+
+        # runs (x, y, count, pitch) within rows
+        runs = []
+        for x, y in lo[sel][order].tolist():
+            if runs:
+                r_x, r_y, num, pitch = runs[-1]
+                if r_y == y and (num == 1 or x == r_x + num * pitch):
+                    runs[-1] = (r_x, r_y, num + 1, x - r_x if num == 1 else pitch)
+                    continue
+            runs.append((x, y, 1, 0))
+
+        # blocks (x, y, columns, column pitch, rows, row pitch) of stacked runs
+        blocks = []
+        for x, y, num, pitch in sorted(runs, key=lambda r: (r[0], r[2], r[3], r[1])):
+            if blocks:
+                b_x, b_y, cols, col_pitch, rows, row_pitch = blocks[-1]
+                if (b_x, cols, col_pitch) == (x, num, pitch) and \
+                        (rows == 1 or y == b_y + rows * row_pitch):
+                    blocks[-1] = (b_x, b_y, cols, col_pitch, rows + 1,
+                                  y - b_y if rows == 1 else row_pitch)
+                    continue
+            blocks.append((x, y, num, pitch, 1, 0))
+
+        for x, y, cols, col_pitch, rows, row_pitch in blocks:
+            if cols == 1 and rows == 1:
+                res.append(gdspy.CellReference(cell, origin=(x, y)))
+            else:
+                spacing = (col_pitch or width, row_pitch or height)
+                res.append(gdspy.CellArray(cell, cols, rows, spacing, origin=(x, y)))
+    return res
+
+
+def enforce_density(sel: np.ndarray, free: np.ndarray, metal_sums: np.ndarray, origin: tuple,
+                    window: int, limits: tuple) -> int:
+    """Resize selected primitives until the density windows are within limits, returns the changes
+
+    `sel` is the selection grid, modified in place, `free` the canvas pixels available to the
+    logo, and `metal_sums` the metal area of all windows of `window` pixels on the chip grid.
+    The canvas starts at `origin` (row, col) of the chip grid. Windows stepped by half their
+    size are visited worst first; primitives touching a window are downgraded or upgraded one
+    step at a time while the window is too dense or too sparse. A change is only made if no
+    window it touches is pushed beyond the limit it moves towards, and the windows are visited
+    again until no change is possible.
+    """
+    stride = KERNEL_DIM - 1
+    lo, hi = [limit / 100.0 * window**2 for limit in limits]
+    canvas = primitive_canvas(*grid_primitives(sel), (free.shape[0] - 1, free.shape[1])) & free
+    step = max(window // 2, 1)
+
+    # canvas rows and columns covered by any primitive relative to its anchor
+    extents = [(d_row - height + 2, d_row + 1, d_col, d_col + width - 1)
+               for width, height, d_col, d_row in PRIMITIVES if width and height]
+    row_lo, row_hi = min(e[0] for e in extents), max(e[1] for e in extents)
+    col_lo, col_hi = min(e[2] for e in extents), max(e[3] for e in extents)
+
+    # part of each stepped window covered by the canvas
+    tops = np.arange(0, metal_sums.shape[0], step)
+    lefts = np.arange(0, metal_sums.shape[1], step)
+    r0 = np.clip(tops - origin[0], 0, canvas.shape[0])
+    r1 = np.clip(tops - origin[0] + window, 0, canvas.shape[0])
+    c0 = np.clip(lefts - origin[1], 0, canvas.shape[1])
+    c1 = np.clip(lefts - origin[1] + window, 0, canvas.shape[1])
+    inside = (r0 < r1)[:, None] & (c0 < c1)[None, :]
+
+    # density of each stepped window from a summed-area table of the canvas
+    sat = np.zeros((canvas.shape[0] + 1, canvas.shape[1] + 1), dtype=np.int64)
+    sat[1:, 1:] = np.cumsum(np.cumsum(canvas, axis=0), axis=1)
+    totals = metal_sums[np.ix_(tops, lefts)] + sat[np.ix_(r1, c1)] - sat[np.ix_(r0, c1)] - \
+        sat[np.ix_(r1, c0)] + sat[np.ix_(r0, c0)]
+
+    def windows(pixel: tuple) -> list:
+        """Stepped windows containing a canvas pixel"""
+        row, col = pixel[0] + origin[0], pixel[1] + origin[1]
+        return [(wy, wx)
+                for wy in range(max(-(-(row - window + 1) // step), 0),
+                                min(row // step, len(tops) - 1) + 1)
+                for wx in range(max(-(-(col - window + 1) // step), 0),
+                                min(col // step, len(lefts) - 1) + 1)]
+
+    def anchors(wy: int, wx: int) -> list:
+        """Primitives whose footprint overlaps a stepped window"""
+        return [(i, j)
+                for i in range(max(-(-(r0[wy] - row_hi) // stride), 0),
+                               min((r1[wy] - 1 - row_lo) // stride + 1, sel.shape[0]))
+                for j in range(max(-(-(c0[wx] - col_hi) // stride), 0),
+                               min((c1[wx] - 1 - col_lo) // stride + 1, sel.shape[1]))]
+
+    def resize(i: int, j: int, grow: bool) -> tuple:
+        """Next primitive, changed pixels, and window changes of a resize, None if impossible"""
+        new = UPGRADE[sel[i, j]] if grow else DOWNGRADE[sel[i, j]]
+        if new == sel[i, j]:
+            return None
+        pixels = footprint(new, i * stride, j * stride) ^ \
+            footprint(sel[i, j], i * stride, j * stride)
+        if grow and not all(free[p] for p in pixels):
+            return None
+        pixels = [p for p in pixels if canvas[p] != grow]
+        delta = {}
+        for p in pixels:
+            for w in windows(p):
+                delta[w] = delta.get(w, 0) + (1 if grow else -1)
+        return new, pixels, delta
+
+    def blocking(delta: dict, grow: bool) -> list:
+        """Windows a change would push beyond the limit it moves towards"""
+        if grow:
+            return [w for w, d in delta.items() if totals[w] + d > hi]
+        return [w for w, d in delta.items() if totals[w] + d < lo]
+
+    def apply(i: int, j: int, grow: bool, new: int, pixels: list, delta: dict):
+        for p in pixels:
+            canvas[p] = grow
+        for w, d in delta.items():
+            totals[w] += d
+        sel[i, j] = new
+
+    def make_room(target: tuple, blocked: list, grow: bool) -> int:
+        """Resize primitives of the blocking windows the other way, away from the target"""
+        made = 0
+        for w in blocked:
+            for i, j in anchors(*w):
+                change = resize(i, j, not grow)
+                if change is not None and target not in change[2] and \
+                        not blocking(change[2], not grow):
+                    apply(i, j, not grow, *change)
+                    made += 1
+                    break
+        return made
+
+    # visit the violating windows worst first until no resize helps any of them; a resize
+    # moves its window towards the limits and no other window beyond them, making room does not
+    # move any window beyond them, so the total violation shrinks and the loop terminates
+    changes = 0
+    moved_any = True
+    while moved_any:
+        moved_any = False
+        excess = np.where(inside, np.maximum(lo - totals, 0) + np.maximum(totals - hi, 0), 0)
+        order = np.argsort(-excess, axis=None, kind='stable')[:np.count_nonzero(excess)]
+        for wy, wx in zip(*np.unravel_index(order, excess.shape)):
+            grow = totals[wy, wx] < lo
+            moved = True
+            while moved and not lo <= totals[wy, wx] <= hi:
+                moved = False
+                for i, j in anchors(wy, wx):
+                    change = resize(i, j, grow)
+                    if change is None or (wy, wx) not in change[2]:
+                        continue
+
+                    # windows at their limit may make room in their part off the target
+                    blocked = blocking(change[2], grow)
+                    if blocked:
+                        changes += make_room((wy, wx), blocked, grow)
+                        change = resize(i, j, grow)
+                        if change is None or (wy, wx) not in change[2] or \
+                                blocking(change[2], grow):
+                            continue
+
+                    apply(i, j, grow, *change)
+                    changes += 1
+                    moved = moved_any = True
+                    if lo <= totals[wy, wx] <= hi:
+                        break
+
+    return changes
+
+
+def density_report(logo_polygons: list, metal_coverage: np.ndarray, chip_box: list,
+                   window: int, limits: tuple):
+    """Print the density of the windows stepped by half their size, and the worst violations"""
+    shape = (metal_coverage.shape[1], metal_coverage.shape[0])
+    logo_coverage = polygon_coverage(logo_polygons, chip_box, shape)
+    total = np.minimum(metal_coverage + logo_coverage, 1.0)
+    if window > min(total.shape):
+        print(f'Density window of {window} pixels exceeds the chip')
+        return
+
+    step = max(window // 2, 1)
+    windows = window_density(total, window)[::step, ::step] * 100.0
+    logo = window_density(logo_coverage, window)[::step, ::step] * 100.0
+    excess = np.maximum(limits[0] - windows, 0) + np.maximum(windows - limits[1], 0)
+    violations = np.count_nonzero(excess)
+
+    # worst windows first
+    if violations:
+        print(f'{"Window (um)":>20} {"logo %":>8} {"total %":>8}')
+    order = np.argsort(-excess, axis=None, kind='stable')[:min(violations, REPORT_VIOLATIONS)]
+    for w_y, w_x in zip(*np.unravel_index(order, excess.shape)):
+        pos = f'{chip_box[0] / 1000.0 + w_x * step * PIXSZ / 1000.0:.1f},' \
+              f'{chip_box[3] / 1000.0 - (w_y * step + window) * PIXSZ / 1000.0:.1f}'
+        print(f'{pos:>20} {logo[w_y, w_x]:8.2f} {windows[w_y, w_x]:8.2f}')
+    if violations > REPORT_VIOLATIONS:
+        print(f'{"...":>20} and {violations - REPORT_VIOLATIONS} more')
+    print(f'Window density: min {windows.min():.2f} %, mean {windows.mean():.2f} %, '
+          f'max {windows.max():.2f} %, {violations} of {windows.size} windows violate '
+          f'[{limits[0]:g}, {limits[1]:g}] %')
+
+
+def read_chip(metal_gds_file: str) -> dict:
+    """Metal polygons and bounding box of the top-metal GDS, converted to consistent DB units"""
+    chip_lib = gdspy.GdsLibrary(name='chip', infile=metal_gds_file, unit=1e-9,
+                                precision=1e-9, units='convert')
+    return {'metal': [poly for cell in chip_lib.top_level() for poly in cell.get_polygons()],
+            'bbox': chip_lib.top_level()[0].get_bounding_box()}
+
+
+def write_bands(writer: gdspy.GdsWriter, image: Image.Image, contrast: float, metal: list,
+                canvas_box: list, band_rows: int, raster_mask: bool, bins: int, jobs: int,
+                logo_layer: int, logo_datatype: int, logo_name: str, arrays: bool,
+                touched: tuple = None, mask: tuple = None) -> tuple:
+    """Process the logo in bands of rows and write each band as a cell, returns (names, area)
+
+    A band holds `band_rows` rows of windows. It reads the rows of its windows plus the rows
+    the windows of the next band overlap with, and covers the canvas rows of its primitives,
+    which never touch the primitives of another band. Only one band is held in memory at once.
+    """
+    stride = KERNEL_DIM - 1
+    img_width, img_height = image.size
+    shape = (img_width, img_height + 1)
+    grid_rows = (img_height - 1 - KERNEL_DIM) // stride + 1
+    boxes = polygon_bboxes(metal)
+    names = []
+    written = set()
+    area = 0.0
+    num_prims = num_rects = num_blocked = 0
+
+    for first in range(0, grid_rows, band_rows):
+        last = min(first + band_rows, grid_rows)
+        top, bottom = first * stride, last * stride
+        logo_image = read_rows(image, top, min(bottom + KERNEL_DIM - stride + 1, img_height),
+                               contrast)
+
+        # the keep-out spans the canvas rows of the band and the image rows it reads
+        if raster_mask:
+            keep_out = canvas_keep_out(metal, boxes, canvas_box, shape, top,
+                                       min(top + logo_image.shape[0] + 1, shape[1]), touched)
+            logo_image = np.where(keep_out[1:], -KERNEL_DIM**2 * 255, logo_image)
+            num_blocked += np.count_nonzero(keep_out[:bottom - top])
+
+        prim, row, col = select_primitives(logo_image)
+        rects = logo_rectangles(prim, row, col, keep_out[:bottom - top] if raster_mask else None)
+        num_prims += len(prim)
+        num_rects += len(rects)
+        if len(rects) == 0:
+            continue
+
+        corners = rectangle_corners(rects, canvas_box, top)
+        if raster_mask:
+            polygons = list(corners)
+        else:
+            polygons = tiled_boolean(corners, metal, bins, jobs, logo_layer, logo_datatype, mask)
+        kept = clean_polygons(polygons)
+        if len(kept) == 0:
+            continue
+        area += polygon_areas(kept).sum()
+
+        band = gdspy.Cell(name=f'{logo_name}_logo_{len(names)}', exclude_from_current=True)
+        if arrays:
+            rect = axis_parallel(kept)
+            refs = array_cells(kept[rect], logo_name, logo_layer, logo_datatype)
+            for ref in refs:
+                if ref.ref_cell.name not in written:
+                    writer.write_cell(ref.ref_cell)
+                    written.add(ref.ref_cell.name)
+            band.add(refs)
+            kept = kept[~rect]
+        if len(kept):
+            band.add(gdspy.PolygonSet(list(kept), layer=logo_layer, datatype=logo_datatype))
+        writer.write_cell(band)
+        names.append(band.name)
+
+    if raster_mask:
+        print(f'Blocked {num_blocked} pixels by existing metal')
+    print(f'Placed {num_prims} dithering primitives as {num_rects} rectangles '
+          f'in {len(names)} bands')
+    return names, area
 
 
 def create_logo(margins: list, img_file: str, contrast: float, metal_gds_file: str,
                 logo_layer: int, logo_datatype: int, logo_name: str, out_svg_file: str,
-                out_gds_file: str):
-    """Translate an image of the proper dimensions to a GDS."""
-
-    # fetch and pre-processes image file
-    logo_image = 255 - np.array(Image.open(img_file).convert('1')) * 255 - int(255 * contrast)
-    [img_height, img_width] = logo_image.shape
-
-    # create a new lib holding the logo
-    logo_lib = gdspy.GdsLibrary(name=logo_name, physical_unit=1e-6, unit=1e-9, precision=1e-9)
-
-    # read-in the metal GDS to mask the logo eventually, convert to get consistent DB units
-    chip_lib = gdspy.GdsLibrary(name='chip', infile=metal_gds_file, unit=1e-9,
-                                precision=1e-9, units='convert')
+                out_gds_file: str, raster_mask: bool = False, bins: int = 1, jobs: int = 1,
+                density_window: float = None, density_limits: tuple = (0.0, 100.0),
+                arrays: bool = False, band_rows: int = None, place: bool = False,
+                out_png_file: str = None, preview_scale: float = 1.0, chip: dict = None):
+    """Translate an image of the proper dimensions to a GDS.
+
+    With `band_rows`, the logo is processed and written in bands of that many image rows;
+    this excludes the density limits, the SVG export, and the placement search, which need
+    the whole logo.
+    With `place`, the margins are chosen to keep the most logo pixels clear of existing metal.
+    With `out_png_file`, a raster preview of the logo and the existing metal is written at
+    `preview_scale` image pixels per logo pixel; without GDS and SVG outputs, that is all.
+    A `chip` as returned by `read_chip` is used instead of reading the metal GDS; if it holds
+    the `touched` raster of `metal_raster`, the keep-out is cut from it where possible, and
+    if it holds the `mask` of `metal_mask`, the boolean uses it instead of growing the metal.
+    """
+
+    # fetch image file, pre-processed row by row
+    image = Image.open(img_file).convert('1')
+    [img_width, img_height] = image.size
+
+    # read-in the metal GDS to mask the logo eventually
+    if chip is None:
+        chip = read_chip(metal_gds_file)
+    metal = chip['metal']
+    touched = chip.get('touched')
 
     # determine the chip height available to the logo
-    bbox_chip = chip_lib.top_level()[0].get_bounding_box()
+    bbox_chip = chip['bbox']
     chip_height = int((bbox_chip[1][1] - bbox_chip[0][1]) // PIXSZ)
     chip_width = int((bbox_chip[1][0] - bbox_chip[0][0]) // PIXSZ)
 
+    # search the offset blocking the fewest logo pixels on the grid of the metal raster
+    if place:
+        if touched is None:
+            touched = metal_raster(metal, bbox_chip)
+        canvas = image_canvas(image, contrast)
+        overlap = placement_overlap(canvas, metal_keep_out(touched[0]))
+        if overlap.size == 0:
+            print('The logo does not fit the chip, no placement search')
+        else:
+            row, col = best_offset(overlap)
+            grid_box = touched[1]
+            margins = [grid_box[0] / PIXSZ + col, grid_box[3] / PIXSZ - row - img_height - 2]
+            center = overlap[(overlap.shape[0] - 1) // 2, (overlap.shape[1] - 1) // 2]
+            print(f'Placed logo at margins {margins[0] * PIXSZ / 1000.0:g},'
+                  f'{margins[1] * PIXSZ / 1000.0:g} um out of {overlap.size} offsets: '
+                  f'{overlap[row, col]} of {np.count_nonzero(canvas)} logo pixels blocked, '
+                  f'{center} when centered')
+
     # center logo or add user-selected margins in pixels!
-    if margin_list:
-        offset_height = margin_list[1]
-        offset_width = margin_list[0]
+    if margins:
+        offset_height = margins[1]
+        offset_width = margins[0]
     else:
         offset_height = (chip_height - img_height) // 2
         offset_width = (chip_width - img_width) // 2
 
-    # create the mask for the existing metalization, use one pixel size spacing
-    mask = gdspy.Cell(name='mask')
-    for top_cell in chip_lib.top_level():
-        mask.add(gdspy.CellReference(top_cell, origin=(0, 0)))
-        mask.add(gdspy.CellReference(top_cell, origin=(-PIXSZ, 0)))
-        mask.add(gdspy.CellReference(top_cell, origin=(PIXSZ, 0)))
-        mask.add(gdspy.CellReference(top_cell, origin=(0, -PIXSZ)))
-        mask.add(gdspy.CellReference(top_cell, origin=(0, PIXSZ)))
+    # the canvas spans the logo and one row above, canvas row r is y = -(r - 1) pixels from the top
+    canvas_box = [offset_width * PIXSZ, (offset_height + 1) * PIXSZ,
+                  (offset_width + img_width) * PIXSZ, (offset_height + img_height + 2) * PIXSZ]
+
+    # stream the logo band by band, the top cell references the bands
+    if band_rows:
+        writer = gdspy.GdsWriter(out_gds_file, name=logo_name, unit=1e-9, precision=1e-9)
+        names, total_metal_area = write_bands(
+            writer, image, contrast, metal, canvas_box, max(band_rows // (KERNEL_DIM - 1), 1),
+            raster_mask, bins, jobs, logo_layer, logo_datatype, logo_name, arrays, touched,
+            chip.get('mask'))
+        # the bands are written already, reference them by name
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            refs = [gdspy.CellReference(name) for name in names]
+        writer.write_cell(gdspy.Cell(name=f'{logo_name}_logo', exclude_from_current=True).add(refs))
+        writer.close()
+        density = total_metal_area / (chip_height * PIXSZ) / (chip_width * PIXSZ) * 100.0
+        print(f'Logo density: {density}')
+        return
+
+    logo_image = read_rows(image, 0, img_height, contrast)
 
-    # create a new cell for the pre-logo
-    pre_logo = gdspy.Cell(name='pre_logo')
+    # create a new lib holding the logo
+    logo_lib = gdspy.GdsLibrary(name=logo_name, physical_unit=1e-6, unit=1e-9, precision=1e-9)
+
+    # raster mask: blocked pixels are white for the primitive selection and are cleared after
+    if raster_mask:
+        keep_out = canvas_keep_out(metal, polygon_bboxes(metal), canvas_box,
+                                   (img_width, img_height + 1), 0, img_height + 1, touched)
+        logo_image = np.where(keep_out[1:], -KERNEL_DIM**2 * 255, logo_image)
+        print(f'Blocked {np.count_nonzero(keep_out)} pixels by existing metal')
 
     # use 2D-convolution to find the most suitable dithering primitive
-    for col in range(0, img_width - KERNEL_DIM, KERNEL_DIM - 1):
-        for row in range(0, img_height - KERNEL_DIM, KERNEL_DIM - 1):
-            sub_img = logo_image[row:row+KERNEL_DIM, col:col+KERNEL_DIM]
-            kernel_val = []
-            for kernel in KERNELS:
-                kernel_val.append(np.sum(sub_img * kernel))
-            sel = kernel_val.index(max(kernel_val))
-            FUNCS[sel](pre_logo, row, col)
-        print(f'{round(col/img_width*100, 2)} %')
-
-    # shift logo and do the boolean subtraction of the mask
-    shifted = pre_logo.copy(name='shifted', deep_copy=False,
-                            translation=(offset_width * PIXSZ, (offset_height + img_height) * PIXSZ))
-
-    logo = gdspy.Cell(name=logo_name)
-    logo.add(gdspy.boolean(shifted, mask, operation='not',
-                           layer=logo_layer, datatype=logo_datatype))
+    sel = selection_grid(logo_image)
+
+    # density windows on the pixel grid of the chip
+    if density_window:
+        chip_box = [bbox_chip[0][0], bbox_chip[0][1], bbox_chip[0][0] + chip_width * PIXSZ,
+                    bbox_chip[0][1] + chip_height * PIXSZ]
+        metal_coverage = polygon_coverage(metal, chip_box, (chip_width, chip_height))
+        window = max(round(density_window * 1000.0 / PIXSZ), 1)
+        origin = (round((chip_box[3] - canvas_box[3]) / PIXSZ),
+                  round((canvas_box[0] - chip_box[0]) / PIXSZ))
+
+        # pixels available to the logo, off chip is free
+        chip_free = ~metal_keep_out(polygon_touched(metal, chip_box, (chip_width, chip_height),
+                                                    metal_coverage))
+        free = np.ones((img_height + 1, img_width), dtype=bool)
+        r0, c0 = max(-origin[0], 0), max(-origin[1], 0)
+        r1 = min(chip_height - origin[0], free.shape[0])
+        c1 = min(chip_width - origin[1], free.shape[1])
+        if r0 < r1 and c0 < c1:
+            free[r0:r1, c0:c1] = chip_free[r0 + origin[0]:r1 + origin[0],
+                                           c0 + origin[1]:c1 + origin[1]]
+
+        if window <= min(chip_height, chip_width):
+            metal_sums = window_density(metal_coverage, window) * window**2
+            changes = enforce_density(sel, free, metal_sums, origin, window, density_limits)
+            print(f'Resized {changes} dithering primitives to meet the density limits')
+
+    prim, row, col = grid_primitives(sel)
+
+    # preview straight from the canvas, the boolean removes what is blocked
+    if out_png_file is not None:
+        canvas = primitive_canvas(prim, row, col, logo_image.shape)
+        if raster_mask:
+            canvas &= ~keep_out
+        canvas_touched = canvas_metal(metal, polygon_bboxes(metal), canvas_box, img_width, 0,
+                                      img_height + 1, touched)
+        preview_image(canvas, canvas_touched, preview_scale).save(out_png_file)
+        if out_gds_file is None and out_svg_file is None:
+            return
+
+    rects = logo_rectangles(prim, row, col, keep_out if raster_mask else None)
+    print(f'Placed {len(prim)} dithering primitives as {len(rects)} rectangles')
+
+    # shift logo, corners are ordered as returned by the boolean
+    corners = rectangle_corners(rects, canvas_box)
+
+    logo = gdspy.Cell(name=logo_name, exclude_from_current=True)
+    if raster_mask:
+        # the mask is on the grid of the logo, no boolean required
+        polygons = list(corners)
+    else:
+        # do the boolean subtraction of the mask, use one pixel size spacing
+        polygons = tiled_boolean(corners, metal, bins, jobs, logo_layer, logo_datatype,
+                                 chip.get('mask'))
+    logo.add(gdspy.PolygonSet(polygons, layer=logo_layer, datatype=logo_datatype))
 
     # cleanup
-    clean_logo = gdspy.Cell(name=f'{logo_name}_logo')
-    for poly in logo.get_polygons():
-        if len(poly) != 4:
-            print(f'Reject {poly} as it has {len(poly)} points')
-        else:
-            p_height = poly[0][0] - poly[1][0]
-            p_width = poly[0][1] - poly[3][1]
-            if (p_height < DB2NM) or (p_width < DB2NM):
-                continue
-            else:
-                current_shape = gdspy.Polygon(poly, layer=logo_layer, datatype=logo_datatype)
-                clean_logo.add(current_shape)
+    clean_logo = gdspy.Cell(name=f'{logo_name}_logo', exclude_from_current=True)
+    kept = clean_polygons(polygons)
+
+    # regular runs of equal rectangles as arrays, the remaining polygons flat
+    flat = kept
+    if arrays:
+        rect = axis_parallel(kept)
+        clean_logo.add(array_cells(kept[rect], logo_name, logo_layer, logo_datatype))
+        flat = kept[~rect]
+    if len(flat):
+        clean_logo.add(gdspy.PolygonSet(list(flat), layer=logo_layer, datatype=logo_datatype))
 
     logo_lib.add(clean_logo)
 
     # calculate metal layer density
-    polygons = clean_logo.get_polygons()
-    total_metal_area = sum(gdspy.Polygon(polygon).area() for polygon in polygons)
-    density = total_metal_area / (chip_height * PIXSZ) / (chip_width * PIXSZ) * 100.0
-    print(f'Logo density: {density}')
+    if density_window:
+        density_report(list(kept), metal_coverage, chip_box, window, density_limits)
+    else:
+        total_metal_area = polygon_areas(kept).sum()
+        density = total_metal_area / (chip_height * PIXSZ) / (chip_width * PIXSZ) * 100.0
+        print(f'Logo density: {density}')
 
     # write to file
-    logo_lib.write_gds(out_gds_file)
+    if out_gds_file is not None:
+        logo_lib.write_gds(out_gds_file)
 
     # if SVG export is requested:
     if out_svg_file is not None:
         # scale and write to file
-        svg_export = gdspy.Cell(name='svg_export')
+        svg_export = gdspy.Cell(name='svg_export', exclude_from_current=True)
         svg_export.add(gdspy.CellReference(logo, magnification=1./DB2NM))
         svg_export.write_svg(out_svg_file, scaling=1, background='#ffffff')
 
@@ -267,11 +1049,54 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--logo_svg', default=None, required=False,
                         help='If present, the name of the svg file to write', type=str)
 
-    parser.add_argument('-o', '--logo_gds', required=True,
+    parser.add_argument('-o', '--logo_gds', default=None, required=False,
                         help='The name of the logo GDS', type=str)
 
+    parser.add_argument('-P', '--logo_png', default=None, required=False,
+                        help='If present, the name of the png preview to write', type=str)
+
+    parser.add_argument('--preview_scale', default=1.0, required=False,
+                        help='Preview pixels per logo pixel', type=float)
+
+    parser.add_argument('-r', '--raster_mask', action='store_true',
+                        help='Mask existing metal on the pixel grid instead of a polygon boolean')
+
+    parser.add_argument('-b', '--bins', default=1, required=False,
+                        help='Bins per axis of the polygon boolean', type=int)
+
+    parser.add_argument('-j', '--jobs', default=1, required=False,
+                        help='Number of worker processes of the polygon boolean', type=int)
+
+    parser.add_argument('-a', '--arrays', action='store_true',
+                        help='Write regular runs of equal rectangles as arrays')
+
+    parser.add_argument('-w', '--density_window', default=None, required=False,
+                        help='Size of the density windows in um, enables density limits',
+                        type=float)
+
+    parser.add_argument('--density_min', default=0.0, required=False,
+                        help='Minimum window density in percent', type=float)
+
+    parser.add_argument('--density_max', default=100.0, required=False,
+                        help='Maximum window density in percent', type=float)
+
+    parser.add_argument('-p', '--place', action='store_true',
+                        help='Search the margins which keep the most logo clear of metal')
+
+    parser.add_argument('--band_rows', default=None, required=False,
+                        help='Process and write the logo in bands of this many image rows',
+                        type=int)
+
     # get the args and process them
     args = parser.parse_args()
+    if not (args.logo_gds or args.logo_png):
+        parser.error('either -o or -P is required')
+    if args.band_rows and (args.density_window or args.logo_svg or args.logo_png or args.place):
+        parser.error('--band_rows cannot be combined with -w, -s, -P, or -p')
+    if args.band_rows and not args.logo_gds:
+        parser.error('--band_rows requires -o')
+    if args.place and args.margins:
+        parser.error('-p cannot be combined with -m')
     if args.margins:
         margin_list = [1000.0 / PIXSZ * float(item) for item in args.margins.split(',')]
     else:
@@ -279,4 +1104,6 @@ if __name__ == '__main__':
 
     # create the logo
     create_logo(margin_list, args.image_file, args.contrast, args.metal_gds, args.logo_layer,
-                args.logo_datatype, args.logo_name, args.logo_svg, args.logo_gds)
+                args.logo_datatype, args.logo_name, args.logo_svg, args.logo_gds, args.raster_mask,
+                args.bins, args.jobs, args.density_window, (args.density_min, args.density_max),
+                args.arrays, args.band_rows, args.place, args.logo_png, args.preview_scale)
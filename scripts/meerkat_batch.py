@@ -0,0 +1,201 @@
+# Copyright 2025 ETH Zurich and University of Bologna.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Thomas Benz <tbenz@iis.ee.ethz.ch>
+# Paul Scheffler <paulsc@iis.ee.ethz.ch>
+# Nils Wistoff <nwistoff@iis.ee.ethz.ch>
+# Philippe Sauter <phsauter@iis.ee.ethz.ch>
+
+"""Translate several logo variants for one chip, parsing the top-metal GDS once."""
+
+import os
+import argparse
+import hashlib
+import json
+import multiprocessing
+import tempfile
+import numpy as np
+
+import meerkat
+
+# chip shared with the worker processes
+_CHIP = None
+
+# version of the cached chip, bump on changes of its format or of the metal raster
+CACHE_VERSION = 2
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_chip(metal_gds_file: str, cache_dir: str) -> dict:
+    """Parsed chip with its metal raster, cached in `cache_dir` keyed by the hash of the GDS
+
+    An unreadable or incomplete cache is parsed again. It is written to a temporary file first
+    and moved in place, so an interrupted or concurrent sweep never leaves a truncated cache.
+    """
+    cache_file = f'{cache_dir}/meerkat_v{CACHE_VERSION}_{file_hash(metal_gds_file)}.npz'
+    if os.path.exists(cache_file):
+        try:
+            with np.load(cache_file) as cache:
+                metal = np.split(cache['vertices'], cache['offsets'][1:-1])
+                chip = {'metal': metal, 'bbox': cache['bbox'],
+                        'touched': (cache['touched'], list(cache['touched_box']))}
+            print(f'Read {len(metal)} metal polygons from {cache_file}')
+            return chip
+        except Exception as err:
+            print(f'Ignoring the unreadable chip cache: {err}')
+
+    chip = meerkat.read_chip(metal_gds_file)
+    touched, touched_box = meerkat.metal_raster(chip['metal'], chip['bbox'])
+    chip['touched'] = (touched, touched_box)
+
+    # polygons are stored as one vertex array split at their offsets
+    offsets = np.concatenate([[0], np.cumsum([len(poly) for poly in chip['metal']])])
+    vertices = np.concatenate(chip['metal']) if chip['metal'] else np.zeros((0, 2))
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.npz', delete=False) as tmp_file:
+            tmp_path = tmp_file.name
+            np.savez(tmp_file, vertices=vertices, offsets=offsets, bbox=chip['bbox'],
+                     touched=touched, touched_box=touched_box)
+        os.replace(tmp_path, cache_file)
+        print(f'Cached {len(chip["metal"])} metal polygons in {cache_file}')
+    except OSError as err:
+        print(f'Could not cache the chip: {err}')
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return chip
+
+
+def variant_name(variant: dict) -> str:
+    """Name of a variant, defaults to the file name of its image without extension"""
+    return variant.get('name', os.path.splitext(os.path.basename(variant['image']))[0])
+
+
+def variant_args(variant: dict, out_dir: str, options: dict) -> tuple:
+    """Arguments of `meerkat.create_logo` for a variant of the batch file
+
+    A variant needs an `image` and a `layer`, and may set `contrast`, `margins` (left and
+    bottom in um) or `place` to search them, `datatype`, `name`, the `gds` and `svg`
+    outputs, and a `png` preview.
+    """
+    name = variant_name(variant)
+    if variant.get('margins'):
+        margins = [1000.0 / meerkat.PIXSZ * float(item) for item in variant['margins']]
+    else:
+        margins = None
+    return (margins, variant['image'], variant.get('contrast', 0.5), None, variant['layer'],
+            variant.get('datatype', 0), name, variant.get('svg'),
+            variant.get('gds', f'{out_dir}/{name}.gds'), options['raster_mask'],
+            options['bins'], 1, options['density_window'], options['density_limits'],
+            options['arrays'], options['band_rows'], variant.get('place', False),
+            variant.get('png'), options['preview_scale'])
+
+
+def _init_worker(chip: dict):
+    global _CHIP
+    _CHIP = chip
+
+
+def _create_logo(args: tuple):
+    meerkat.create_logo(*args, chip=_CHIP)
+    return args[8]
+
+
+def create_logos(metal_gds_file: str, variants: list, out_dir: str, cache_dir: str,
+                 jobs: int, options: dict):
+    """Translate all variants, reading the chip once and each variant in its own process
+
+    The raster of the chip is cached on disk, the grown metal of the polygon boolean is built
+    once per batch and shared with all variants.
+    """
+    chip = load_chip(metal_gds_file, cache_dir)
+    if not options['raster_mask']:
+        chip['mask'] = meerkat.metal_mask(chip['metal'])
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = [variant_args(variant, out_dir, options) for variant in variants]
+    with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(chip, )) as pool:
+        for gds_file in pool.imap_unordered(_create_logo, tasks):
+            print(f'Wrote {gds_file}')
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser(
+                        prog='Meerkat batch',
+                        description='Translate several logo variants for one chip')
+
+    parser.add_argument('variants', help='JSON list of the logo variants', type=str)
+
+    parser.add_argument('-g', '--metal_gds', required=True,
+                        help='The current top-metal GDS file', type=str)
+
+    parser.add_argument('-o', '--out_dir', default='.', required=False,
+                        help='Directory of the logo GDS files', type=str)
+
+    parser.add_argument('-C', '--cache_dir', default=None, required=False,
+                        help='Directory of the chip cache, defaults to the one of the GDS',
+                        type=str)
+
+    parser.add_argument('-j', '--jobs', default=os.cpu_count(), required=False,
+                        help='Number of variants processed in parallel', type=int)
+
+    parser.add_argument('-r', '--raster_mask', action='store_true',
+                        help='Mask existing metal on the pixel grid instead of a polygon boolean')
+
+    parser.add_argument('-b', '--bins', default=1, required=False,
+                        help='Bins per axis of the polygon boolean', type=int)
+
+    parser.add_argument('-a', '--arrays', action='store_true',
+                        help='Write regular runs of equal rectangles as arrays')
+
+    parser.add_argument('-w', '--density_window', default=None, required=False,
+                        help='Size of the density windows in um, enables density limits',
+                        type=float)
+
+    parser.add_argument('--density_min', default=0.0, required=False,
+                        help='Minimum window density in percent', type=float)
+
+    parser.add_argument('--density_max', default=100.0, required=False,
+                        help='Maximum window density in percent', type=float)
+
+    parser.add_argument('--preview_scale', default=1.0, required=False,
+                        help='Preview pixels per logo pixel', type=float)
+
+    parser.add_argument('--band_rows', default=None, required=False,
+                        help='Process and write the logos in bands of this many image rows',
+                        type=int)
+
+    # get the args and process them
+    args = parser.parse_args()
+
+    with open(args.variants, 'r') as f:
+        variant_list = json.load(f)
+
+    names = [variant_name(v) for v in variant_list]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        parser.error(f'variant names must be unique, repeated: {", ".join(duplicates)}')
+
+    if any(v.get('place') and v.get('margins') for v in variant_list):
+        parser.error('place cannot be combined with margins')
+
+    if args.band_rows and (args.density_window or
+                           any(v.get('svg') or v.get('png') or v.get('place')
+                               for v in variant_list)):
+        parser.error('--band_rows cannot be combined with -w, SVG outputs, previews, or place')
+
+    create_logos(args.metal_gds, variant_list, args.out_dir,
+                 args.cache_dir or os.path.dirname(os.path.abspath(args.metal_gds)), args.jobs,
+                 {'raster_mask': args.raster_mask, 'bins': args.bins, 'arrays': args.arrays,
+                  'density_window': args.density_window,
+                  'density_limits': (args.density_min, args.density_max),
+                  'band_rows': args.band_rows, 'preview_scale': args.preview_scale})
@@ -0,0 +1,147 @@
+# Copyright 2025 ETH Zurich and University of Bologna.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Thomas Benz <tbenz@iis.ee.ethz.ch>
+# Paul Scheffler <paulsc@iis.ee.ethz.ch>
+# Nils Wistoff <nwistoff@iis.ee.ethz.ch>
+# Philippe Sauter <phsauter@iis.ee.ethz.ch>
+
+"""Export the RAW layer tiles tile by tile, sharded over worker processes"""
+
+import argparse
+import json
+import multiprocessing
+
+from PIL import Image
+
+from analyze import tile_boxes as tile_boxes
+from raster import coverage_mask as coverage_mask
+from raster import raw_file as raw_file
+import poly_store
+
+# view configuration, matches png_export.lym
+VIEW_CONFIG = {
+    'ruler-color': '#FFFFFF',
+    'background-color': '#FFFFFF',
+    'grid-visible': 'false',
+    'images-visible': 'false',
+    'text-color': '#FFFFFF',
+    'text-visible': 'false'
+}
+
+
+class KLayoutExporter:
+    """Render tiles with a headless KLayout view, all layers of a zoom box at once"""
+
+    def __init__(self, data: dict):
+        # the standalone KLayout modules are only required for this exporter
+        import klayout.db as db
+        import klayout.lay as lay
+
+        self.data = data
+        self.db = db
+        self.dbu = data['tech']['db_unit_nm'] / 1000.0
+
+        # fetch layout
+        self.view = lay.LayoutView()
+        for key, value in VIEW_CONFIG.items():
+            self.view.set_config(key, value)
+        self.view.load_layout(data['gds']['file'], True)
+        self.view.load_layer_props(f'{data["work"]["dir"]}/{data["general"]["chip"]}.lyp')
+        self.view.max_hier()
+
+        # get the active layers
+        self.layers = []
+        it = self.view.begin_layers()
+        while not it.at_end():
+            lp = it.current()
+            if lp.visible and not lp.has_children() and lp.layer_index() >= 0:
+                self.layers.append(lp)
+            it.next()
+
+    def export_tile(self, x: int, y: int, box: list, size: tuple):
+        self.view.zoom_box(self.db.DBox(*[v * self.dbu for v in box]))
+        for lp in self.layers:
+            for other in self.layers:
+                other.visible = other is lp
+            self.view.save_image(raw_file(self.data, lp.name, x, y), *size)
+
+    def close(self):
+        for lp in self.layers:
+            lp.visible = True
+
+
+class CoverageExporter:
+    """Render tiles from the polygon store with exact area coverage"""
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.store = poly_store.open_store(poly_store.store_dir(data))
+        self.arrays = {layer: poly_store.load_layer(self.store, layer) for layer in data['colors']}
+
+    def export_tile(self, x: int, y: int, box: list, size: tuple):
+        for layer, arrays in self.arrays.items():
+            mask = coverage_mask(poly_store.query(self.store, arrays, box), box, size)
+            Image.fromarray(255 - mask, mode='L').save(raw_file(self.data, layer, x, y))
+
+    def close(self):
+        pass
+
+
+EXPORTERS = {'klayout': KLayoutExporter, 'coverage': CoverageExporter}
+
+
+def shard_tiles(tiles: list, num_shards: int, shard: int) -> list:
+    """Tiles of one shard, interleaved to balance dense and sparse regions"""
+    return tiles[shard::num_shards]
+
+
+def export_shard(data: dict, exporter, num_shards: int, shard: int) -> list:
+    """Export all tiles of a shard with a single exporter instance, returns their coordinates"""
+    tiles = shard_tiles(tile_boxes(data), num_shards, shard)
+    if not tiles:
+        return []
+
+    inst = exporter(data)
+    for x, y, box, size in tiles:
+        print(f'[{shard}] Working on block: x:{x} y:{y} -> ({box})')
+        inst.export_tile(x, y, box, size)
+    inst.close()
+
+    return [(x, y) for x, y, _, _ in tiles]
+
+
+def export(data: dict, exporter, jobs: int) -> list:
+    """Export all tiles using `jobs` worker processes, each loading the layout once"""
+    if jobs <= 1:
+        return export_shard(data, exporter, 1, 0)
+
+    with multiprocessing.Pool(jobs) as pool:
+        shards = pool.starmap(export_shard, [(data, exporter, jobs, s) for s in range(jobs)])
+    return [tile for shard in shards for tile in shard]
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser(
+                        prog='png_export',
+                        description='Export the RAW layer tiles')
+
+    parser.add_argument('chip_json', help='The chip configuration', type=str)
+
+    parser.add_argument('-j', '--jobs', default=1, required=False,
+                        help='Number of worker processes', type=int)
+
+    parser.add_argument('-e', '--exporter', default='klayout', required=False,
+                        choices=EXPORTERS.keys(), help='Rendering backend', type=str)
+
+    # get the args and process them
+    args = parser.parse_args()
+
+    with open(args.chip_json, 'r') as f:
+        data = json.load(f)
+
+    # only render if armed
+    if not data['tech']['dry_run']:
+        export(data, EXPORTERS[args.exporter], args.jobs)
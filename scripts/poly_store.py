@@ -0,0 +1,177 @@
+# Copyright 2025 ETH Zurich and University of Bologna.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Thomas Benz <tbenz@iis.ee.ethz.ch>
+# Paul Scheffler <paulsc@iis.ee.ethz.ch>
+# Nils Wistoff <nwistoff@iis.ee.ethz.ch>
+# Philippe Sauter <phsauter@iis.ee.ethz.ch>
+
+"""Flatten the layers of a chip into a binned polygon store"""
+
+import argparse
+import json
+import os
+import numpy as np
+
+from analyze import analyze as analyze
+
+STORE_VERSION = 1
+
+
+def store_dir(data: dict) -> str:
+    return f'{data["work"]["dir"]}/STORE__{data["general"]["chip"]}'
+
+
+def store_grid(data: dict, bins_per_tile: int) -> dict:
+    """Bin grid aligned to the render tile grid, in dbu"""
+    info = analyze(data)
+    return {
+        'x0': int(info['tot_gds_x_offset']),
+        'y0': int(info['tot_gds_y_offset']),
+        'bin_w': info['tot_gds_width'] / info['tiles_w'] / bins_per_tile,
+        'bin_h': info['tot_gds_height'] / info['tiles_h'] / bins_per_tile,
+        'nx': info['tiles_w'] * bins_per_tile,
+        'ny': info['tiles_h'] * bins_per_tile
+    }
+
+
+def bin_box(grid: dict, ix: int, iy: int) -> list:
+    """Box of a bin in dbu: left, bottom, right, top"""
+    return [round(grid['x0'] + ix * grid['bin_w']),
+            round(grid['y0'] + iy * grid['bin_h']),
+            round(grid['x0'] + (ix + 1) * grid['bin_w']),
+            round(grid['y0'] + (iy + 1) * grid['bin_h'])]
+
+
+def build_store(data: dict, bins_per_tile: int):
+    """Flatten, merge, and clip each layer of `colors` to the bins and write the arrays"""
+    # klayout is only required to build the store, not to read it
+    import pya
+
+    out_dir = store_dir(data)
+    grid = store_grid(data, bins_per_tile)
+
+    # fetch layout
+    layout = pya.Layout()
+    layout.read(data['gds']['file'])
+    top = layout.top_cell().cell_index()
+
+    meta = {'version': STORE_VERSION, 'grid': grid, 'dbu': layout.dbu, 'layers': {},
+            'source': {'file': data['gds']['file'],
+                       'size': os.path.getsize(data['gds']['file']),
+                       'mtime': os.path.getmtime(data['gds']['file'])}}
+
+    for name, color in data['colors'].items():
+        layer_num, layer_id = [int(v) for v in color['layer'].split('/')]
+        li = layout.find_layer(layer_num, layer_id)
+
+        # per-bin arrays, concatenated once per layer
+        vertices = []
+        lengths = []
+        bins = [0]
+
+        # bins are stored row by row, polygons are clipped to their bin
+        for iy in range(grid['ny']):
+            for ix in range(grid['nx']):
+                num_polygons = 0
+                if li is not None:
+                    box = pya.Box(*bin_box(grid, ix, iy))
+                    region = pya.Region(layout.begin_shapes_touching(top, li, box))
+                    points = []
+                    counts = []
+                    for poly in (region.merged() & pya.Region(box)).each():
+                        start = len(points)
+                        points.extend((p.x, p.y) for p in poly.to_simple_polygon().each_point())
+                        counts.append(len(points) - start)
+                    if counts:
+                        vertices.append(np.array(points, dtype=np.int32).reshape(-1, 2))
+                        lengths.append(np.array(counts, dtype=np.int64))
+                        num_polygons = len(counts)
+                bins.append(bins[-1] + num_polygons)
+            print(f'{name}: {round((iy + 1) / grid["ny"] * 100, 2)} %')
+
+        # write arrays, these are memory-mapped by readers
+        os.makedirs(f'{out_dir}/{name}', exist_ok=True)
+        np.save(f'{out_dir}/{name}/vertices.npy',
+                np.concatenate(vertices + [np.zeros((0, 2), dtype=np.int32)]))
+        del vertices
+        lengths = np.concatenate(lengths + [np.zeros(0, dtype=np.int64)])
+        np.save(f'{out_dir}/{name}/offsets.npy',
+                np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+        np.save(f'{out_dir}/{name}/bins.npy', np.array(bins, dtype=np.int64))
+        meta['layers'][name] = color['layer']
+
+    with open(f'{out_dir}/meta.json', 'w') as f:
+        json.dump(meta, f, indent=4)
+
+
+def open_store(path: str) -> dict:
+    """Read the store meta data"""
+    with open(f'{path}/meta.json', 'r') as f:
+        meta = json.load(f)
+    if meta.get('version') != STORE_VERSION:
+        raise ValueError(f'Unsupported store version in {path}')
+    meta['path'] = path
+    return meta
+
+
+def load_layer(store: dict, layer: str) -> dict:
+    """Memory-map the arrays of a layer"""
+    path = f'{store["path"]}/{layer}'
+    return {key: np.load(f'{path}/{key}.npy', mmap_mode='r')
+            for key in ['vertices', 'offsets', 'bins']}
+
+
+def bin_range(store: dict, box: list) -> tuple:
+    """Bin index ranges (ix0, ix1, iy0, iy1) touching a box in dbu"""
+    grid = store['grid']
+    ix0 = max(int((box[0] - grid['x0']) // grid['bin_w']), 0)
+    iy0 = max(int((box[1] - grid['y0']) // grid['bin_h']), 0)
+    ix1 = min(int(-(-(box[2] - grid['x0']) // grid['bin_w'])), grid['nx'])
+    iy1 = min(int(-(-(box[3] - grid['y0']) // grid['bin_h'])), grid['ny'])
+    return ix0, ix1, iy0, iy1
+
+
+def query(store: dict, arrays: dict, box: list):
+    """Yield (vertices, offsets) chunks of all polygons in bins touching a box in dbu
+
+    Vertices are zero-copy views into the memory-mapped store, offsets are rebased to the
+    chunk. Polygons are clipped to their bin, so no polygon is returned twice.
+    """
+    yield from query_bins(store, arrays, *bin_range(store, box))
+
+
+def query_bins(store: dict, arrays: dict, ix0: int, ix1: int, iy0: int, iy1: int):
+    """Yield (vertices, offsets) chunks of all polygons in the bins ix0 to ix1, iy0 to iy1
+
+    Ends are exclusive; chunks are as returned by `query`.
+    """
+    if ix0 >= ix1:
+        return
+    for iy in range(iy0, iy1):
+        first = iy * store['grid']['nx']
+        p0, p1 = arrays['bins'][first + ix0], arrays['bins'][first + ix1]
+        if p1 > p0:
+            offsets = np.asarray(arrays['offsets'][p0:p1 + 1])
+            yield arrays['vertices'][offsets[0]:offsets[-1]], offsets - offsets[0]
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser(
+                        prog='poly_store',
+                        description='Flatten the layers of a chip into a binned polygon store')
+
+    parser.add_argument('chip_json', help='The chip configuration', type=str)
+
+    parser.add_argument('-b', '--bins', default=4, required=False,
+                        help='Bins per render tile and axis', type=int)
+
+    # get the args and process them
+    args = parser.parse_args()
+
+    with open(args.chip_json, 'r') as f:
+        data = json.load(f)
+
+    build_store(data, args.bins)
@@ -0,0 +1,367 @@
+# Copyright 2025 ETH Zurich and University of Bologna.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Thomas Benz <tbenz@iis.ee.ethz.ch>
+# Paul Scheffler <paulsc@iis.ee.ethz.ch>
+# Nils Wistoff <nwistoff@iis.ee.ethz.ch>
+# Philippe Sauter <phsauter@iis.ee.ethz.ch>
+
+"""Build the OpenStreetMap tile pyramid in-process"""
+
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import sqlite3
+import numpy as np
+
+from PIL import Image
+
+from mapify import map_info as map_info
+
+# renders easily exceed the decompression bomb limit of Pillow
+Image.MAX_IMAGE_PIXELS = None
+
+MANIFEST_VERSION = 2
+
+
+def box_reduce(children: dict, size: int) -> np.ndarray:
+    """2x2 box reduction of up to four RGBA children keyed by (dx, dy), missing ones are empty
+
+    Color is averaged alpha-weighted, so transparent padding does not darken the edges.
+    """
+    mosaic = np.zeros((2 * size, 2 * size, 4), dtype=np.uint32)
+    for (dx, dy), child in children.items():
+        mosaic[dy * size:(dy + 1) * size, dx * size:(dx + 1) * size] = child
+
+    alpha = mosaic[..., 3:4]
+    premul = mosaic[..., :3] * alpha
+
+    def pool(a):
+        return a[0::2, 0::2] + a[1::2, 0::2] + a[0::2, 1::2] + a[1::2, 1::2]
+
+    a_sum = pool(alpha)
+    rgb = (pool(premul) + a_sum // 2) // np.maximum(a_sum, 1)
+    return np.concatenate([rgb, (a_sum + 2) // 4], axis=-1).astype(np.uint8)
+
+
+def reduce_level(tiles: dict, size: int, load=None) -> dict:
+    """Build the parents of the tiles (x, y) of a level
+
+    Siblings not among the tiles are fetched using `load(x, y)` if given, else they are empty.
+    """
+    parents = {}
+    for (x, y), tile in tiles.items():
+        parents.setdefault((x // 2, y // 2), {})[(x % 2, y % 2)] = tile
+
+    if load is not None:
+        for (p_x, p_y), children in parents.items():
+            for dx in range(2):
+                for dy in range(2):
+                    if (dx, dy) not in children:
+                        sibling = load(2 * p_x + dx, 2 * p_y + dy)
+                        if sibling is not None:
+                            children[(dx, dy)] = sibling
+
+    return {key: box_reduce(children, size) for key, children in parents.items()}
+
+
+def tile_image(tile: np.ndarray) -> Image.Image:
+    """Store opaque tiles without alpha, gray ones as such, and binary masks with one bit"""
+    if np.all(tile[..., 3] == 255):
+        rgb = tile[..., :3]
+        if np.array_equal(rgb[..., 0], rgb[..., 1]) and np.array_equal(rgb[..., 0], rgb[..., 2]):
+            gray = np.ascontiguousarray(rgb[..., 0])
+            if np.all((gray == 0) | (gray == 255)):
+                return Image.fromarray(gray == 255)
+            return Image.fromarray(gray, 'L')
+        return Image.fromarray(np.ascontiguousarray(rgb), 'RGB')
+    return Image.fromarray(tile, 'RGBA')
+
+
+def encode_tile(tile: np.ndarray) -> bytes:
+    buf = io.BytesIO()
+    tile_image(tile).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def decode_tile(payload: bytes) -> np.ndarray:
+    return np.asarray(Image.open(io.BytesIO(payload)).convert('RGBA'))
+
+
+class DirectorySink:
+    """Tiles as {output}/{stem}/{z}/{x}/{y}.png, the manifest next to them"""
+
+    def __init__(self, info: dict, stem: str):
+        self.path = f'{info["output"]}/{info["sub_map_names"][stem]}'
+
+    def put(self, zoom: int, x: int, y: int, payload: bytes):
+        os.makedirs(f'{self.path}/{zoom}/{x}', exist_ok=True)
+        with open(f'{self.path}/{zoom}/{x}/{y}.png', 'wb') as f:
+            f.write(payload)
+
+    def get(self, zoom: int, x: int, y: int) -> bytes:
+        path = f'{self.path}/{zoom}/{x}/{y}.png'
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def has(self, zoom: int, x: int, y: int) -> bool:
+        return os.path.exists(f'{self.path}/{zoom}/{x}/{y}.png')
+
+    def read_manifest(self) -> dict:
+        path = f'{self.path}/manifest.json'
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def write_manifest(self, manifest: dict):
+        os.makedirs(self.path, exist_ok=True)
+        with open(f'{self.path}/manifest.json', 'w') as f:
+            json.dump(manifest, f, indent=4)
+
+    def close(self):
+        pass
+
+
+class ArchiveSink:
+    """All tiles of a stem in one MBTiles file {output}/{stem}.mbtiles
+
+    Payloads are stored once per content hash, so empty and padding tiles take no space.
+    Rows are counted from the bottom (TMS), as required by MBTiles.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+        CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER,
+                                        tile_row INTEGER, tile_id TEXT,
+                                        PRIMARY KEY (zoom_level, tile_column, tile_row));
+        CREATE VIEW IF NOT EXISTS tiles AS
+            SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+                   map.tile_row AS tile_row, images.tile_data AS tile_data
+            FROM map JOIN images ON images.tile_id = map.tile_id;
+    '''
+
+    def __init__(self, info: dict, stem: str):
+        os.makedirs(info['output'], exist_ok=True)
+        self.name = info['sub_map_names'][stem]
+        self.max_zoom = info['max_zoom_lvl']
+        self.db = sqlite3.connect(f'{info["output"]}/{self.name}.mbtiles')
+        self.db.executescript(self.SCHEMA)
+
+    def put(self, zoom: int, x: int, y: int, payload: bytes):
+        tile_id = hashlib.sha1(payload).hexdigest()
+        self.db.execute('INSERT OR IGNORE INTO images VALUES (?, ?)', (tile_id, payload))
+        self.db.execute('INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)',
+                        (zoom, x, 2**zoom - 1 - y, tile_id))
+
+    def get(self, zoom: int, x: int, y: int) -> bytes:
+        row = self.db.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND '
+                              'tile_column = ? AND tile_row = ?',
+                              (zoom, x, 2**zoom - 1 - y)).fetchone()
+        return row[0] if row else None
+
+    def has(self, zoom: int, x: int, y: int) -> bool:
+        return self.db.execute('SELECT 1 FROM map WHERE zoom_level = ? AND tile_column = ? AND '
+                               'tile_row = ?', (zoom, x, 2**zoom - 1 - y)).fetchone() is not None
+
+    def read_manifest(self) -> dict:
+        row = self.db.execute('SELECT value FROM metadata WHERE name = ?',
+                              ('manifest', )).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def write_manifest(self, manifest: dict):
+        self.db.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?)',
+                        ('manifest', json.dumps(manifest)))
+
+    def close(self):
+        meta = {'name': self.name, 'format': 'png', 'type': 'overlay',
+                'minzoom': '0', 'maxzoom': str(self.max_zoom)}
+        self.db.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)', meta.items())
+        # drop payloads no longer referenced by a rebuilt tile
+        self.db.execute('DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)')
+        self.db.commit()
+        self.db.close()
+
+
+SINKS = {'dir': DirectorySink, 'mbtiles': ArchiveSink}
+
+
+def file_state(path: str, known: dict = None) -> dict:
+    """Size, modification time and hash of a file; the hash is reused if size and time match"""
+    stat = os.stat(path)
+    if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+        return known
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest.hexdigest()}
+
+
+def pyramid_params(info: dict) -> dict:
+    """Parameters which invalidate all tiles of a stem when changed"""
+    return {'version': MANIFEST_VERSION,
+            **{key: info[key] for key in ['num_tiles_x', 'num_tiles_y', 'map_tile_size',
+                                          'tile_size', 'max_zoom_lvl', 'merge_zoom_lvl']}}
+
+
+def source_tile(info: dict, stem: str, t_x: int, t_y: int) -> np.ndarray:
+    """Source tile scaled to fit `tile_size` like `convert -resize`, padded transparent
+
+    Renders are larger than the tile size by their overrender factor.
+    """
+    size = info['tile_size']
+    img = Image.open(f'{info["root"]}/{stem}_{t_y}-{t_x}.png').convert('RGBA')
+    if img.size != (size, size):
+        scale = size / max(img.size)
+        img = img.resize((max(round(img.width * scale), 1), max(round(img.height * scale), 1)),
+                         Image.LANCZOS)
+    tile = np.zeros((size, size, 4), dtype=np.uint8)
+    tile[:img.height, :img.width] = np.asarray(img)
+    return tile
+
+
+def build_source_tile(info: dict, stem: str, t_x: int, t_y: int) -> tuple:
+    """Cut a source tile into base-level map tiles and reduce them as long as they are whole
+
+    Returns the stem, the zoom level reached, the tiles of that level, and the encoded tiles
+    (zoom, x, y, png) of all levels; these are stored by the parent process.
+    """
+    size = info['map_tile_size']
+    src = source_tile(info, stem, t_x, t_y)
+
+    # map tiles per source tile and axis, source row 0 is the bottom of the chip
+    num = info['tile_size'] // size
+    x_base = num * t_x
+    y_base = num * (info['num_tiles_y'] - 1 - t_y)
+    zoom = info['max_zoom_lvl']
+
+    tiles = {}
+    encoded = []
+    for m_y in range(num):
+        for m_x in range(num):
+            tiles[(x_base + m_x, y_base + m_y)] = src[m_y * size:(m_y + 1) * size,
+                                                      m_x * size:(m_x + 1) * size]
+
+    # parents are owned by this source tile while the tile count is even
+    while True:
+        encoded.extend((zoom, x, y, encode_tile(tile)) for (x, y), tile in tiles.items())
+        if num % 2 or zoom == 0:
+            break
+        tiles = reduce_level(tiles, size)
+        num //= 2
+        zoom -= 1
+
+    return stem, zoom, tiles, encoded
+
+
+def _build_source_tile(task: tuple) -> tuple:
+    return build_source_tile(*task)
+
+
+def finish_stem(info: dict, sink, zoom: int, tiles: dict):
+    """Propagate rebuilt tiles to level zero, pad the levels up to the merge level
+
+    Only the parents of rebuilt tiles are merged again, their unchanged siblings are read back.
+    """
+    size = info['map_tile_size']
+    empty = encode_tile(np.zeros((size, size, 4), dtype=np.uint8))
+
+    def load(z, x, y):
+        payload = sink.get(z, x, y)
+        return None if payload is None else decode_tile(payload)
+
+    while True:
+        # complete the levels up to the merge level with empty tiles
+        if zoom <= info['merge_zoom_lvl']:
+            for x in range(2**zoom):
+                for y in range(2**zoom):
+                    if (x, y) not in tiles and not sink.has(zoom, x, y):
+                        sink.put(zoom, x, y, empty)
+        if zoom == 0:
+            break
+        tiles = reduce_level(tiles, size, lambda x, y, z=zoom: load(z, x, y))
+        zoom -= 1
+        for (x, y), tile in tiles.items():
+            sink.put(zoom, x, y, encode_tile(tile))
+
+
+def build_pyramid(data: dict, jobs: int, force: bool = False, sink_type=DirectorySink):
+    """Build the zoom levels of all stems, only source tiles changed since the last run are read"""
+    info = map_info(data)
+    params = pyramid_params(info)
+    sinks = {stem: sink_type(info, stem) for stem in info['stems']}
+
+    # find the source tiles which changed
+    tasks = []
+    manifests = {}
+    for stem in info['stems']:
+        known = sinks[stem].read_manifest()
+        if force or known.get('params') != params:
+            known = {}
+
+        sources = {}
+        for t_y in range(info['num_tiles_y']):
+            for t_x in range(info['num_tiles_x']):
+                name = f'{stem}_{t_y}-{t_x}.png'
+                old = known.get('sources', {}).get(name)
+                sources[name] = file_state(f'{info["root"]}/{name}', old)
+                if old is None or old['hash'] != sources[name]['hash']:
+                    tasks.append((info, stem, t_x, t_y))
+        manifests[stem] = {'params': params, 'sources': sources}
+
+    if not tasks:
+        print('All tiles are up to date')
+
+    # base levels, one task per changed source tile, stored as they arrive
+    levels = {}
+    with multiprocessing.Pool(jobs) as pool:
+        for stem, zoom, tiles, encoded in pool.imap_unordered(_build_source_tile, tasks):
+            for z, x, y, payload in encoded:
+                sinks[stem].put(z, x, y, payload)
+            levels.setdefault(stem, [zoom, {}])[1].update(tiles)
+            print(f'{stem}: {len(tiles)} tiles on level {zoom}')
+
+    # remaining levels span multiple source tiles
+    for stem, (zoom, tiles) in levels.items():
+        finish_stem(info, sinks[stem], zoom, tiles)
+
+    # record the sources only once their tiles are complete
+    for stem, manifest in manifests.items():
+        sinks[stem].write_manifest(manifest)
+        sinks[stem].close()
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser(
+                        prog='pyramid',
+                        description='Build the OpenStreetMap tile pyramid in-process')
+
+    parser.add_argument('chip_json', help='The chip configuration', type=str)
+
+    parser.add_argument('-j', '--jobs', default=os.cpu_count(), required=False,
+                        help='Number of worker processes', type=int)
+
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Rebuild all tiles, ignore the manifest')
+
+    parser.add_argument('-o', '--output_format', default='dir', required=False,
+                        choices=SINKS.keys(), help='Tile directories or MBTiles archives',
+                        type=str)
+
+    # get the args and process them
+    args = parser.parse_args()
+
+    with open(args.chip_json, 'r') as f:
+        data = json.load(f)
+
+    build_pyramid(data, args.jobs, args.force, SINKS[args.output_format])
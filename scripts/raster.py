@@ -0,0 +1,180 @@
+# Copyright 2025 ETH Zurich and University of Bologna.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Thomas Benz <tbenz@iis.ee.ethz.ch>
+# Paul Scheffler <paulsc@iis.ee.ethz.ch>
+# Nils Wistoff <nwistoff@iis.ee.ethz.ch>
+# Philippe Sauter <phsauter@iis.ee.ethz.ch>
+
+"""Rasterize polygons to exact per-pixel area coverage"""
+
+import argparse
+import json
+import numpy as np
+
+from PIL import Image
+
+from analyze import tile_boxes as tile_boxes
+import poly_store
+
+# sub-steps per pixel row used to integrate non-Manhattan edges
+SUBDIV = 4
+
+# rows accumulated at once, bounds the size of the accumulation buffer
+BAND_ROWS = 1024
+
+
+def _edges(chunks, box: list, shape: tuple) -> tuple:
+    """Collect all polygon edges in pixel units (x right, y up)"""
+    px_w = (box[2] - box[0]) / shape[0]
+    px_h = (box[3] - box[1]) / shape[1]
+    starts = []
+    ends = []
+    for vertices, offsets in chunks:
+        if len(vertices) == 0:
+            continue
+        pts = (np.asarray(vertices, dtype=np.float64) - [box[0], box[1]]) / [px_w, px_h]
+        nxt = np.arange(1, len(pts) + 1)
+        nxt[offsets[1:] - 1] = offsets[:-1]
+        starts.append(pts)
+        ends.append(pts[nxt])
+    if not starts:
+        return (np.zeros((0, 2)), ) * 2
+    return np.concatenate(starts), np.concatenate(ends)
+
+
+def _vertical_edges(p0: np.ndarray, p1: np.ndarray, height: int) -> tuple:
+    """Express all edges as vertical edges (x, y_low, y_high, sign)
+
+    Vertical edges are exact; other edges are integrated using SUBDIV vertical steps per
+    pixel row, placed at the mid-height of each step. Horizontal edges do not contribute.
+    """
+    sign = np.sign(p1[:, 1] - p0[:, 1])
+    keep = sign != 0
+    p0, p1, sign = p0[keep], p1[keep], sign[keep]
+    y_lo = np.minimum(p0[:, 1], p1[:, 1])
+    y_hi = np.maximum(p0[:, 1], p1[:, 1])
+
+    vertical = p0[:, 0] == p1[:, 0]
+    xs = [p0[vertical, 0]]
+    lows = [y_lo[vertical]]
+    highs = [y_hi[vertical]]
+    signs = [sign[vertical]]
+
+    # clip slanted edges to the rows of interest before sub-dividing them
+    sl = ~vertical & (y_hi > 0) & (y_lo < height)
+    if np.any(sl):
+        a, b, s = p0[sl], p1[sl], sign[sl]
+        lo = np.clip(y_lo[sl], 0, height)
+        hi = np.clip(y_hi[sl], 0, height)
+        steps = np.maximum(np.ceil((hi - lo) * SUBDIV).astype(np.int64), 1)
+        idx = np.repeat(np.arange(len(steps)), steps)
+        k = np.arange(len(idx)) - np.repeat(np.cumsum(steps) - steps, steps)
+        step = (hi - lo)[idx] / steps[idx]
+        seg_lo = lo[idx] + k * step
+        mid = seg_lo + step / 2
+        slope = (b[:, 0] - a[:, 0]) / (b[:, 1] - a[:, 1])
+        xs.append(a[idx, 0] + (mid - a[idx, 1]) * slope[idx])
+        lows.append(seg_lo)
+        highs.append(seg_lo + step)
+        signs.append(s[idx])
+
+    return np.concatenate(xs), np.concatenate(lows), np.concatenate(highs), np.concatenate(signs)
+
+
+def _accumulate(x, y_lo, y_hi, sign, width: int, height: int) -> np.ndarray:
+    """Integrate the winding number of vertical edges over each pixel
+
+    Each edge adds its signed height to all pixels right of it. This is scattered as a
+    separable difference (x: partial pixel + rest of row; y: partial rows at both ends) and
+    resolved by a cumulative sum along both axes.
+    """
+    x = np.maximum(x, 0.0)
+    y_lo = np.clip(y_lo, 0.0, height)
+    y_hi = np.clip(y_hi, 0.0, height)
+    keep = (x < width) & (y_lo < y_hi)
+    x, y_lo, y_hi, sign = x[keep], y_lo[keep], y_hi[keep], sign[keep]
+
+    xi = np.floor(x).astype(np.int64)
+    fx = x - xi
+    idx = []
+    wgt = []
+    for y, s in ((y_lo, sign), (y_hi, -sign)):
+        yi = np.floor(y).astype(np.int64)
+        fy = y - yi
+        for dy, wy in ((0, 1.0 - fy), (1, fy)):
+            for dx, wx in ((0, 1.0 - fx), (1, fx)):
+                idx.append((yi + dy) * (width + 1) + xi + dx)
+                wgt.append(s * wy * wx)
+
+    diff = np.bincount(np.concatenate(idx), weights=np.concatenate(wgt),
+                       minlength=(height + 2) * (width + 1))
+    diff = diff.reshape(height + 2, width + 1)
+    return np.cumsum(np.cumsum(diff, axis=0), axis=1)[:height, :width]
+
+
+def coverage(chunks, box: list, shape: tuple) -> np.ndarray:
+    """Exact area coverage in [0, 1] of each pixel of a window
+
+    `chunks` yields (vertices, offsets) of non-overlapping polygons as returned by
+    `poly_store.query`, `box` is the window (left, bottom, right, top) in dbu and `shape` the
+    image size (width, height) in px. The result is in image orientation (first row on top).
+    """
+    width, height = shape
+    p0, p1 = _edges(chunks, box, shape)
+    res = np.zeros((height, width), dtype=np.float32)
+
+    for row in range(0, height, BAND_ROWS):
+        rows = min(BAND_ROWS, height - row)
+        in_band = (np.maximum(p0[:, 1], p1[:, 1]) > row) & \
+                  (np.minimum(p0[:, 1], p1[:, 1]) < row + rows)
+        if not np.any(in_band):
+            continue
+        shift = np.array([0.0, row])
+        edges = _vertical_edges(p0[in_band] - shift, p1[in_band] - shift, rows)
+        band = np.abs(_accumulate(*edges, width, rows))
+        res[height - row - rows:height - row] = np.minimum(band, 1.0)[::-1]
+
+    return res
+
+
+def coverage_mask(chunks, box: list, shape: tuple) -> np.ndarray:
+    """8-bit coverage mask of a window"""
+    return np.rint(coverage(chunks, box, shape) * 255.0).astype(np.uint8)
+
+
+def raw_file(data: dict, layer: str, x: int, y: int) -> str:
+    layer_id = data['colors'][layer]['layer'].replace('/', '.')
+    return f'{data["work"]["dir"]}/RAW__{data["general"]["chip"]}_{layer_id}.{layer}_{y}-{x}.png'
+
+
+def render_raw_tiles(data: dict, store_path: str, layers: list = None):
+    """Write the RAW tiles of all layers: black coverage on white, as exported by KLayout"""
+    store = poly_store.open_store(store_path)
+    for layer in layers or data['colors']:
+        arrays = poly_store.load_layer(store, layer)
+        for x, y, box, size in tile_boxes(data):
+            print(f'Working on block: {layer} - x:{x} y:{y} -> ({box})')
+            mask = coverage_mask(poly_store.query(store, arrays, box), box, size)
+            Image.fromarray(255 - mask, mode='L').save(raw_file(data, layer, x, y))
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser(
+                        prog='raster',
+                        description='Rasterize the polygon store to anti-aliased RAW tiles')
+
+    parser.add_argument('chip_json', help='The chip configuration', type=str)
+
+    parser.add_argument('-l', '--layers', nargs='*', default=None,
+                        help='Only rasterize these layers', type=str)
+
+    # get the args and process them
+    args = parser.parse_args()
+
+    with open(args.chip_json, 'r') as f:
+        data = json.load(f)
+
+    render_raw_tiles(data, poly_store.store_dir(data), args.layers)
@@ -0,0 +1,220 @@
+# Copyright 2025 ETH Zurich and University of Bologna.
+# Licensed under the Apache License, Version 2.0, see LICENSE for details.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Thomas Benz <tbenz@iis.ee.ethz.ch>
+# Paul Scheffler <paulsc@iis.ee.ethz.ch>
+# Nils Wistoff <nwistoff@iis.ee.ethz.ch>
+# Philippe Sauter <phsauter@iis.ee.ethz.ch>
+
+"""Serve map tiles composited from the per-layer pyramids with a live palette"""
+
+import argparse
+import io
+import json
+import re
+import numpy as np
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+from mapify import map_info as map_info
+from pyramid import SINKS as SINKS
+
+# only serve to the local machine
+HOST = '127.0.0.1'
+
+
+def parse_color(color: str) -> tuple:
+    """RGB of '#RRGGBB', 'RRGGBB', or 'rgb(r, g, b)'"""
+    match = re.fullmatch(r'rgb\(\s*(\d+)\s*,\s*(\d+)\s*,\s*(\d+)\s*\)', color.strip())
+    if match:
+        return tuple(int(v) for v in match.groups())
+    value = color.strip().lstrip('#')
+    if not re.fullmatch(r'[0-9a-fA-F]{6}', value):
+        raise ValueError(f'Unsupported color {color}')
+    return tuple(int(value[i:i + 2], 16) for i in (0, 2, 4))
+
+
+def default_palette(data: dict, layers: list) -> tuple:
+    """(layer, rgb, alpha) of the served layers in stacking order, from the configuration"""
+    return tuple((layer, parse_color(data['colors'][layer]['color']),
+                  float(data['colors'][layer]['alpha']))
+                 for layer in data['tech']['layer_order'] if layer in layers)
+
+
+def query_palette(query: dict, palette: tuple) -> tuple:
+    """Apply the layer selection and order (layers=M1,M2) and overrides (M1=ff0000, M1_alpha=0.5)"""
+    known = {layer: (rgb, alpha) for layer, rgb, alpha in palette}
+    if 'layers' in query:
+        layers = [layer for layer in query['layers'][0].split(',') if layer]
+    else:
+        layers = list(known)
+
+    res = []
+    for layer in layers:
+        if layer not in known:
+            raise ValueError(f'Unknown layer {layer}')
+        rgb, alpha = known[layer]
+        if layer in query:
+            rgb = parse_color(query[layer][0])
+        if f'{layer}_alpha' in query:
+            alpha = min(max(float(query[f'{layer}_alpha'][0]), 0.0), 1.0)
+        res.append((layer, rgb, alpha))
+    return tuple(res)
+
+
+def composite(masks: list, palette: tuple, size: int) -> np.ndarray:
+    """Blend the layer masks over black, matching the COL and MRG rules of the Makefile
+
+    A mask value v (metal is black) covers (255 - v) / 255 of a pixel, the layer color is
+    blended with its alpha times this coverage. The kept fraction and the added color are
+    looked up per mask value from two tables of each layer.
+    """
+    res = np.zeros((size, size, 3), dtype=np.float32)
+    cov = (255.0 - np.arange(256, dtype=np.float32)) / 255.0
+    for mask, (_, rgb, alpha) in zip(masks, palette):
+        if mask is None:
+            continue
+        weight = alpha * cov
+        keep = (1.0 - weight)[:, None]
+        add = weight[:, None] * np.array(rgb, dtype=np.float32)
+        res = res * keep[mask] + add[mask]
+    return np.rint(res).astype(np.uint8)
+
+
+class TileCache:
+    """LRU cache of encoded tiles, bounded by the total size of the payloads"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        payload = self.entries.get(key)
+        if payload is not None:
+            self.entries.move_to_end(key)
+        return payload
+
+    def put(self, key, payload: bytes):
+        if len(payload) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = payload
+        self.size += len(payload)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class TileServer:
+    """Composite tiles of the layer stems of a map on request"""
+
+    def __init__(self, data: dict, sink_type, cache_bytes: int):
+        info = map_info(data)
+        self.size = info['map_tile_size']
+        # stems of single layers are named after the layer
+        self.sinks = {info['sub_map_names'][stem]: sink_type(info, stem) for stem in info['stems']
+                      if info['sub_map_names'][stem] in data['colors']}
+        self.palette = default_palette(data, self.sinks)
+        self.cache = TileCache(cache_bytes)
+
+    def mask(self, layer: str, zoom: int, x: int, y: int) -> np.ndarray:
+        """Mask of a layer tile, transparent padding covers nothing"""
+        payload = self.sinks[layer].get(zoom, x, y)
+        if payload is None:
+            return None
+        tile = np.asarray(Image.open(io.BytesIO(payload)).convert('LA')).astype(np.uint32)
+        cov = (255 - tile[..., 0]) * tile[..., 1]
+        return (255 - (cov + 127) // 255).astype(np.uint8)
+
+    def tile(self, zoom: int, x: int, y: int, palette: tuple) -> bytes:
+        """Encoded tile, None if no layer has a tile at this position"""
+        key = (zoom, x, y, palette)
+        payload = self.cache.get(key)
+        if payload is None:
+            masks = [self.mask(layer, zoom, x, y) for layer, _, _ in palette]
+            if all(mask is None for mask in masks):
+                return None
+            buf = io.BytesIO()
+            Image.fromarray(composite(masks, palette, self.size), 'RGB').save(buf, format='PNG')
+            payload = buf.getvalue()
+            self.cache.put(key, payload)
+        return payload
+
+
+def make_handler(server: TileServer):
+    class Handler(BaseHTTPRequestHandler):
+        def send_payload(self, payload: bytes, content_type: str):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(payload)))
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+
+            # the configured palette, e.g., to build a layer selection
+            if url.path == '/palette.json':
+                palette = [{'layer': layer, 'color': '#{:02X}{:02X}{:02X}'.format(*rgb),
+                            'alpha': alpha} for layer, rgb, alpha in server.palette]
+                self.send_payload(json.dumps(palette).encode(), 'application/json')
+                return
+
+            match = re.fullmatch(r'/(\d+)/(\d+)/(\d+)\.png', url.path)
+            if not match:
+                self.send_error(404)
+                return
+            try:
+                palette = query_palette(parse_qs(url.query), server.palette)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+
+            payload = server.tile(*[int(v) for v in match.groups()], palette)
+            if payload is None:
+                self.send_error(404)
+                return
+            self.send_payload(payload, 'image/png')
+
+    return Handler
+
+
+if __name__ == '__main__':
+    # argparser
+    parser = argparse.ArgumentParser(
+                        prog='tile_server',
+                        description='Serve map tiles composited from the per-layer pyramids')
+
+    parser.add_argument('chip_json', help='The chip configuration', type=str)
+
+    parser.add_argument('-p', '--port', default=8080, required=False,
+                        help='Port on localhost', type=int)
+
+    parser.add_argument('-c', '--cache', default=256, required=False,
+                        help='Size of the tile cache in MiB', type=int)
+
+    parser.add_argument('-o', '--output_format', default='dir', required=False,
+                        choices=SINKS.keys(), help='Format the pyramids were built in', type=str)
+
+    # get the args and process them
+    args = parser.parse_args()
+
+    with open(args.chip_json, 'r') as f:
+        data = json.load(f)
+
+    server = TileServer(data, SINKS[args.output_format], args.cache * 2**20)
+    httpd = HTTPServer((HOST, args.port), make_handler(server))
+    print(f'Serving {", ".join(server.sinks)} on http://{HOST}:{args.port}/{{z}}/{{x}}/{{y}}.png')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        httpd.server_close()